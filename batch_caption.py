@@ -1,21 +1,57 @@
 import argparse
+import math
+import time
+from itertools import chain
 from pathlib import Path
 import torch
 from PIL import Image
-from transformers import AutoProcessor, LlavaForConditionalGeneration
+from transformers import AutoProcessor, LlavaForConditionalGeneration, StoppingCriteria, StoppingCriteriaList
 
-def load_model(model_path):
+from caption_cache import CaptionCache, cache_context
+from metrics import GenerationTimer, PrometheusExporter, metrics
+from prompt_cache import PromptCache
+from sources import batched, iter_images, open_image
+
+def load_hf_model(model_path, device_map="auto"):
     print("Loading JoyCaption model")
     processor = AutoProcessor.from_pretrained(model_path)
+    # Batched generation needs the prompts padded on the left so new tokens line up
+    processor.tokenizer.padding_side = "left"
     model = LlavaForConditionalGeneration.from_pretrained(
         model_path, 
         torch_dtype=torch.bfloat16, 
-        device_map="auto"
+        device_map=device_map
     )
     model.eval()
     print("Model loaded successfully!")
     return processor, model
 
+def load_cpu_fast_model(model_path, device_map=None, **options):
+    from cpu_fast import load_cpu_fast_model
+    
+    return load_cpu_fast_model(model_path, **options)
+
+def load_onnx_model(model_path, device_map=None, **options):
+    from onnx_backend import load_onnx_model
+    
+    return load_onnx_model(model_path, **options)
+
+# A backend loader returns (processor, model). The model only has to provide
+# generate(input_ids, attention_mask, pixel_values, **generation_kwargs) returning the prompt
+# followed by the new token ids, as transformers does, and call streamer.put/end like it when
+# a streamer is passed. --continuous and --styles also need a
+# transformers model, since they drive the KV cache and the vision tower directly.
+BACKENDS = {
+    "default": load_hf_model,
+    "cpu-fast": load_cpu_fast_model,
+    "onnx": load_onnx_model,
+}
+
+def load_model(model_path, device_map="auto", backend="default", **backend_options):
+    return BACKENDS[backend](model_path, device_map=device_map, **backend_options)
+
+CAPTION_STYLES = ["descriptive", "straightforward", "training"]
+
 def get_caption_prompt(style="descriptive"):
     if style == "descriptive":
         return "Write a long detailed description for this image."
@@ -36,104 +72,691 @@ def get_caption_prompt(style="descriptive"):
     else:
         return "Write a long detailed description for this image."
 
-def caption_image(processor, model, image_path, style="descriptive"):
-    try:
-        image = Image.open(image_path).convert('RGB')
-        
-        prompt = get_caption_prompt(style)
-        
-        convo = [
-            {
-                "role": "system",
-                "content": "You are a helpful image captioner.",
-            },
-            {
-                "role": "user", 
-                "content": prompt,
-            },
-        ]
-        convo_string = processor.apply_chat_template(convo, tokenize=False, add_generation_prompt=True)
-        
-        inputs = processor(text=[convo_string], images=[image], return_tensors="pt")
-        
-        if torch.cuda.is_available():
+GENERATION_KWARGS = {
+    "max_new_tokens": 512,
+    "do_sample": True,
+    "suppress_tokens": None,
+    "use_cache": True,
+    "temperature": 0.6,
+    "top_k": None,
+    "top_p": 0.9,
+}
+
+def render_convo_string(processor, style="descriptive"):
+    prompt = get_caption_prompt(style)
+    
+    convo = [
+        {
+            "role": "system",
+            "content": "You are a helpful image captioner.",
+        },
+        {
+            "role": "user", 
+            "content": prompt,
+        },
+    ]
+    return processor.apply_chat_template(convo, tokenize=False, add_generation_prompt=True)
+
+prompt_caches = {}
+
+def get_prompt_cache(processor):
+    """Return the PromptCache for this processor, creating it on first use."""
+    entry = prompt_caches.get(id(processor))
+    if entry is None or entry[0] is not processor:
+        entry = (processor, PromptCache(processor, lambda style: render_convo_string(processor, style)))
+        prompt_caches[id(processor)] = entry
+    return entry[1]
+
+def build_convo_string(processor, style="descriptive"):
+    return get_prompt_cache(processor).convo_string(style)
+
+def preprocess(processor, images, style="descriptive"):
+    with metrics.stage("preprocess"):
+        return get_prompt_cache(processor).preprocess(images, style)
+
+def move_to_device(inputs):
+    if torch.cuda.is_available():
+        with metrics.stage("h2d"):
             inputs = {k: v.to('cuda') if hasattr(v, 'to') else v for k, v in inputs.items()}
             if 'pixel_values' in inputs:
                 inputs['pixel_values'] = inputs['pixel_values'].to(torch.bfloat16)
+    return inputs
+
+def prepare_inputs(processor, images, style="descriptive"):
+    return move_to_device(preprocess(processor, images, style))
+
+def collate_inputs(processor, items):
+    """Merge single-image processor outputs into one left-padded batch."""
+    batch = processor.tokenizer.pad(
+        {
+            "input_ids": [item["input_ids"][0] for item in items],
+            "attention_mask": [item["attention_mask"][0] for item in items],
+        },
+        return_tensors="pt",
+    )
+    batch = dict(batch)
+    for key in items[0].keys():
+        if key not in batch:
+            batch[key] = torch.cat([item[key] for item in items], dim=0)
+    return batch
+
+def generate_from_inputs(processor, model, inputs, generation_kwargs=None):
+    generation_kwargs = generation_kwargs or GENERATION_KWARGS
+    if metrics.enabled:
+        generation_kwargs = dict(generation_kwargs, streamer=GenerationTimer(metrics, inputs['input_ids'].shape[0]))
+    with torch.no_grad():
+        generate_ids = model.generate(**inputs, **generation_kwargs)
         
-        with torch.no_grad():
-            generate_ids = model.generate(
-                **inputs,
-                max_new_tokens=512,
-                do_sample=True,
-                suppress_tokens=None,
-                use_cache=True,
-                temperature=0.6,
-                top_k=None,
-                top_p=0.9,
-            )[0]
-            
-            generate_ids = generate_ids[inputs['input_ids'].shape[1]:]
-            
-            caption = processor.tokenizer.decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-            caption = caption.strip()
-            
-        return caption
+        # Prompts are left padded to a common length, so the new tokens start at the same offset for every row
+        generate_ids = generate_ids[:, inputs['input_ids'].shape[1]:]
         
+        with metrics.stage("detokenize"):
+            captions = processor.tokenizer.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+    
+    if metrics.enabled:
+        record_tokens((generate_ids != processor.tokenizer.pad_token_id).sum(dim=1).tolist())
+    return [caption.strip() for caption in captions]
+
+def record_tokens(token_counts):
+    metrics.count("images_captioned", len(token_counts))
+    metrics.count("tokens_generated", sum(token_counts))
+    for token_count in token_counts:
+        metrics.observe("tokens_per_image", token_count)
+
+class StopOnEvent(StoppingCriteria):
+    """Ends generate() after the current token once event is set, so a cancelled run does not wait for the batch."""
+    
+    def __init__(self, event):
+        self.event = event
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+def cancellable_kwargs(event, generation_kwargs=None):
+    """Generation settings that stop generating once event is set; captions cut short this way are incomplete."""
+    return dict(generation_kwargs or GENERATION_KWARGS, stopping_criteria=StoppingCriteriaList([StopOnEvent(event)]))
+
+def generate_captions(processor, model, images, style="descriptive", generation_kwargs=None):
+    """Run a single generate call over already decoded images and return one caption per image."""
+    return generate_from_inputs(processor, model, prepare_inputs(processor, images, style), generation_kwargs)
+
+def get_target_size(processor):
+    """Return the (width, height) the processor resizes images to, or None if it cannot be determined."""
+    image_processor = getattr(processor, "image_processor", None)
+    size = getattr(image_processor, "size", None) or {}
+    crop_size = getattr(image_processor, "crop_size", None) or {}
+    if "height" in size and "width" in size:
+        return size["width"], size["height"]
+    if "shortest_edge" in size:
+        edge = max(size["shortest_edge"], crop_size.get("height", 0), crop_size.get("width", 0))
+        return edge, edge
+    return None
+
+def load_image(image_path, target_size=None, margin=2.0):
+    """Open an image as RGB, optionally shrinking it early when it is much larger than target_size.
+    
+    JPEGs are decoded at a reduced DCT scale via draft mode, which skips most of the decode work
+    for large camera images. Other formats are downscaled once after decoding. The image is kept
+    at least margin times the target on both sides so the processor's own resize still does the
+    final filtering.
+    """
+    with metrics.stage("image_decode"):
+        image = open_image(image_path)
+        if target_size is None:
+            return image.convert('RGB')
+        
+        width, height = image.size
+        scale = max(target_size[0] / width, target_size[1] / height) * margin
+        if scale >= 1:
+            return image.convert('RGB')
+        
+        min_size = (math.ceil(width * scale), math.ceil(height * scale))
+        if image.format == "JPEG":
+            image.draft('RGB', min_size)
+        image = image.convert('RGB')
+        if image.width > min_size[0] and image.height > min_size[1]:
+            image = image.resize(min_size, Image.BICUBIC, reducing_gap=3.0)
+        return image
+
+def caption_images(processor, model, image_paths, style="descriptive", log=print, target_size=None, generation_kwargs=None,
+                   on_error=None):
+    """Caption a batch of images with one generate call.
+    
+    Returns a list aligned with image_paths. Images that fail to load or caption get None,
+    so one corrupt file does not fail the rest of the batch; on_error(image_path, error) is
+    called for each of them.
+    """
+    def fail(image_path, error):
+        log(f"Error captioning {image_path}: {str(error)}")
+        if on_error is not None:
+            on_error(image_path, str(error))
+    
+    captions = [None] * len(image_paths)
+    images = []
+    indices = []
+    for i, image_path in enumerate(image_paths):
+        try:
+            images.append(load_image(image_path, target_size))
+            indices.append(i)
+        except Exception as e:
+            fail(image_path, e)
+    
+    if not images:
+        return captions
+    
+    try:
+        batch_captions = generate_captions(processor, model, images, style, generation_kwargs)
     except Exception as e:
-        print(f"Error captioning {image_path}: {str(e)}")
-        return None
+        if len(images) == 1:
+            fail(image_paths[indices[0]], e)
+            return captions
+        # Fall back to one image at a time to find the image that broke the batch
+        batch_captions = []
+        for i, image in zip(indices, images):
+            try:
+                batch_captions.extend(generate_captions(processor, model, [image], style, generation_kwargs))
+            except Exception as e:
+                fail(image_paths[i], e)
+                batch_captions.append(None)
+    
+    for i, caption in zip(indices, batch_captions):
+        captions[i] = caption
+    return captions
+
+def caption_image(processor, model, image_path, style="descriptive", target_size=None):
+    return caption_images(processor, model, [image_path], style, target_size=target_size)[0]
+
+def caption_path(image_path, style=None):
+    """Sidecar caption file; multi-style runs write one <name>_<style>.txt per style."""
+    image_path = Path(image_path)
+    if style is None:
+        return image_path.with_suffix('.txt')
+    return image_path.with_name(f"{image_path.stem}_{style}.txt")
+
+def write_caption(image_path, caption, style=None, **info):
+    with open(caption_path(image_path, style), 'w', encoding='utf-8') as f:
+        f.write(caption)
 
 def main():
+    from cpu_fast import CPU_DTYPES
+    from sinks import OUTPUT_FORMATS, open_sink
+    
     parser = argparse.ArgumentParser(description="Caption images using JoyCaption")
-    parser.add_argument("folder", help="Path to folder containing images")
+    parser.add_argument("folder", help="Path to folder containing images, or a tar/zip shard")
     parser.add_argument("--model", default="llama-joycaption-beta-one-hf-llava", 
                        help="Path to JoyCaption model")
-    parser.add_argument("--style", choices=["descriptive", "straightforward", "training"], 
+    parser.add_argument("--backend", choices=list(BACKENDS), default="default", 
+                       help="cpu-fast: int8 language model for machines without a GPU; "
+                            "onnx: ONNX Runtime, with --model pointing at an onnx_backend.py export")
+    parser.add_argument("--cpu-dtype", choices=CPU_DTYPES, default="auto", 
+                       help="Vision encoder precision for --backend cpu-fast; auto picks bfloat16 when the CPU supports it")
+    parser.add_argument("--threads", type=int, default=None, 
+                       help="Intra-op threads for --backend cpu-fast or onnx")
+    parser.add_argument("--interop-threads", type=int, default=None, 
+                       help="Inter-op threads for --backend cpu-fast or onnx")
+    parser.add_argument("--compile", action="store_true", 
+                       help="Compile the language model with torch.compile for --backend cpu-fast")
+    parser.add_argument("--style", choices=CAPTION_STYLES, 
                        default="training", help="Caption style")
+    parser.add_argument("--styles", 
+                       help="Comma separated styles captioned in one pass, written to <name>_<style>.txt")
+    parser.add_argument("--feature-store", 
+                       help="Directory for cached vision features used by --styles")
+    parser.add_argument("--recursive", action="store_true", 
+                       help="Also caption images in subfolders")
+    parser.add_argument("--shards", action="store_true", 
+                       help="Also caption images inside tar/zip shards found in the folder")
     parser.add_argument("--overwrite", action="store_true", 
                        help="Overwrite existing caption files")
+    parser.add_argument("--batch-size", type=int, default=1, 
+                       help="Number of images captioned per generate call")
+    parser.add_argument("--continuous", action="store_true", 
+                       help="Use continuous batching: refill a batch slot as soon as its caption finishes")
+    parser.add_argument("--pipeline", action="store_true", 
+                       help="Overlap image decoding, preprocessing, generation and file writes")
+    parser.add_argument("--readers", type=int, default=2, 
+                       help="Image decoding threads used by --pipeline")
+    parser.add_argument("--preprocess-workers", type=int, default=2, 
+                       help="Preprocessing threads used by --pipeline")
+    parser.add_argument("--queue-depth", type=int, default=8, 
+                       help="Maximum items waiting between --pipeline stages")
+    parser.add_argument("--fast-load", action="store_true", 
+                       help="Decode large images at reduced resolution before preprocessing")
+    parser.add_argument("--cache", 
+                       help="SQLite caption cache keyed by image content; also captions duplicate images once")
+    parser.add_argument("--cache-max-entries", type=int, default=None, 
+                       help="Evict least recently used captions beyond this many entries")
+    parser.add_argument("--near-dup-threshold", type=int, default=None, 
+                       help="Caption one image per cluster of near-duplicates within this many perceptual hash bits")
+    parser.add_argument("--hash-workers", type=int, default=8, 
+                       help="Threads used to compute perceptual hashes")
+    parser.add_argument("--workers", type=int, default=1, 
+                       help="Worker processes, each loading its own model")
+    parser.add_argument("--devices", 
+                       help="Comma separated devices assigned round-robin to --workers, e.g. cuda:0,cuda:1")
+    parser.add_argument("--threads-per-worker", type=int, default=None, 
+                       help="Pin each worker to this many CPU cores")
+    parser.add_argument("--server", 
+                       help="Send images to a running caption_server.py at this URL instead of loading a model")
+    parser.add_argument("--concurrency", type=int, default=8, 
+                       help="Requests kept in flight to --server so the daemon can batch them")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default="txt", 
+                       help="Write sidecar .txt files, one JSONL file, Parquet shards or WebDataset tar shards")
+    parser.add_argument("--output", 
+                       help="Output file (jsonl) or directory (parquet, tar); defaults to inside the image folder")
+    parser.add_argument("--flush-every", type=int, default=None, 
+                       help="Captions buffered per atomic write for jsonl, parquet and tar output")
+    parser.add_argument("--journal", 
+                       help="SQLite file recording the state of every image so the run can be resumed")
+    parser.add_argument("--resume", action="store_true", 
+                       help="Continue the run recorded in --journal where it stopped")
+    parser.add_argument("--retry-failed", action="store_true", 
+                       help="Caption again only the images --journal recorded as failed")
+    parser.add_argument("--metrics", action="store_true", 
+                       help="Print a table of per-stage times, token counts, cache counters and queue depths at the end")
+    parser.add_argument("--trace", 
+                       help="Write a Chrome trace JSON of every stage to this file")
+    parser.add_argument("--prometheus", 
+                       help="Keep a Prometheus text file with the run's metrics up to date at this path")
+    parser.add_argument("--prometheus-interval", type=float, default=15.0, 
+                       help="Seconds between rewrites of the --prometheus file")
     
     args = parser.parse_args()
     
-    processor, model = load_model(args.model)
+    styles = None
+    if args.styles:
+        styles = [style.strip() for style in args.styles.split(",") if style.strip()]
+        unknown = [style for style in styles if style not in CAPTION_STYLES]
+        if unknown:
+            parser.error(f"unknown styles: {', '.join(unknown)}")
+        if args.continuous or args.pipeline or args.cache or args.near_dup_threshold is not None or args.workers > 1:
+            parser.error("--styles cannot be combined with --continuous, --pipeline, --cache, "
+                         "--near-dup-threshold or --workers")
+    if args.backend == "onnx" and (args.continuous or args.styles):
+        parser.error("--backend onnx cannot be combined with --continuous or --styles")
+    if args.workers > 1 and (args.continuous or args.pipeline):
+        parser.error("--workers cannot be combined with --continuous or --pipeline")
+    if args.server and (args.continuous or args.pipeline or args.styles or args.workers > 1):
+        parser.error("--server cannot be combined with --continuous, --pipeline, --styles or --workers")
     
     folder_path = Path(args.folder)
-    supported_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.webp'}
+    if not folder_path.exists():
+        parser.error(f"{args.folder} does not exist")
+    if args.output_format == "txt" and (args.shards or folder_path.is_file()):
+        parser.error("images inside shards need --output-format jsonl, parquet or tar")
+    
+    journal = None
+    if args.journal:
+        from journal import RunJournal
+        
+        journal = RunJournal(args.journal)
+        settings = {
+            "folder": str(folder_path.resolve()),
+            "style": args.style,
+            "styles": styles,
+            "recursive": args.recursive,
+            "shards": args.shards,
+            "output_format": args.output_format,
+            "output": args.output,
+        }
+        if args.resume or args.retry_failed:
+            if journal.settings is None:
+                parser.error(f"{args.journal} has no run to resume")
+            if journal.settings != settings:
+                parser.error(f"{args.journal} was recorded with a different folder, style or output")
+            print(journal.report())
+        else:
+            journal.start(settings)
+    elif args.resume or args.retry_failed:
+        parser.error("--resume and --retry-failed need --journal")
     
-    image_files = []
-    for ext in supported_extensions:
-        image_files.extend(folder_path.glob(f"*{ext}"))
-        image_files.extend(folder_path.glob(f"*{ext.upper()}"))
+    # Images are discovered lazily, so captioning starts before the whole folder has been scanned
+    found = 0
     
-    if not image_files:
+    def count(image_files):
+        nonlocal found
+        for image_file in image_files:
+            found += 1
+            yield image_file
+    
+    # The cache and near-duplicate clustering list every image up front, so shard members are
+    # read on demand instead of holding the whole dataset in memory
+    listed = args.cache or args.near_dup_threshold is not None
+    image_files = count(iter_images(folder_path, recursive=args.recursive, shards=args.shards, keep_data=not listed))
+    sink = open_sink(args.output_format, args.output, folder_path if folder_path.is_dir() else folder_path.parent,
+                     model=args.model, style=args.style, flush_every=args.flush_every)
+    if journal is not None:
+        journal.before_commit = sink.flush
+    exporter = None
+    if args.metrics or args.trace or args.prometheus:
+        metrics.enable(trace=bool(args.trace))
+        if args.prometheus:
+            exporter = PrometheusExporter(metrics, args.prometheus, args.prometheus_interval).start()
+    try:
+        processed = caption_folder(args, styles, image_files, sink, journal)
+    finally:
+        sink.close()
+        if journal is not None:
+            print(journal.report())
+            journal.close()
+        if metrics.enabled:
+            if exporter is not None:
+                exporter.stop()
+            if args.trace:
+                metrics.write_trace(args.trace)
+                print(f"Trace written to {args.trace}")
+            print(metrics.summary())
+    
+    if args.resume or args.retry_failed:
+        print(f"Processing completed! Captioned {processed} images")
+        return
+    if not found:
         print("No image files found in the folder")
         return
     
-    print(f"Found {len(image_files)} image files")
+    print(f"Processing completed! Found {found} images, captioned {processed}")
+
+def caption_folder(args, styles, image_files, sink, journal=None):
+    resuming = journal is not None and (args.resume or args.retry_failed)
     
-    processed = 0
-    for i, image_file in enumerate(image_files):
-        caption_file = image_file.with_suffix('.txt')
-        
-        if caption_file.exists() and not args.overwrite:
-            print(f"Skipping {image_file.name} caption already exists")
-            continue
-        
-        print(f"Processing {i+1}/{len(image_files)}: {image_file.name}")
+    from journal import DONE, FAILED, IN_FLIGHT, PENDING
+    
+    def pending():
+        if resuming:
+            states = ([PENDING, IN_FLIGHT] if args.resume else []) + ([FAILED] if args.retry_failed else [])
+            yield from journal.items(states)
+            if not args.resume or journal.enumerated:
+                return
+        for image_file in image_files:
+            if journal is not None:
+                # Images the interrupted run already recorded are not checked again
+                if resuming and journal.knows(image_file):
+                    continue
+                journal.add(image_file)
+            if not args.overwrite and all(sink.done(image_file, style) for style in (styles or [None])):
+                print(f"Skipping {image_file.name} caption already exists")
+                if journal is not None:
+                    journal.set_state(image_file, DONE)
+                continue
+            yield image_file
+        if journal is not None:
+            journal.mark_enumerated()
+    
+    pending_files = pending()
+    write_fn = metrics.timed("write", sink.write)
+    log = print
+    on_error = journal.mark_failed if journal is not None else None
+    
+    if styles:
+        # An image is only done once every style is saved, so the journal is updated per image
+        on_done = journal.mark_done if journal is not None else None
+        processed = run_multi_style(args, styles, dispatch(journal, pending_files), write_fn, log, on_done, on_error)
+        if journal is not None:
+            journal.finish()
+        return processed
+    
+    if journal is not None:
+        write_fn = journal.writer(write_fn)
+    
+    base_write_fn = write_fn
+    member_write_fn = write_fn
+    cache = None
+    if args.cache:
+        # Deduplicating against the whole run needs the full list up front
+        pending_files = list(pending_files)
+        cache = CaptionCache(args.cache, max_entries=args.cache_max_entries)
+        context = cache_context(args.model, args.style, get_caption_prompt(args.style), GENERATION_KWARGS,
+                                args.backend, backend_options(args))
+        pending_files, cache_keys, duplicates = cache.plan(pending_files, context, base_write_fn)
+        write_fn = cache.writer(cache_keys, duplicates, base_write_fn)
+        # Near-duplicates borrow a caption, which must not be cached under their own content
+        member_write_fn = cache.writer(cache_keys, duplicates, base_write_fn, store=False)
+    
+    if args.near_dup_threshold is not None:
+        from near_duplicates import cluster_near_duplicates, propagating_writer
         
-        caption = caption_image(processor, model, image_file, args.style)
+        pending_files = list(pending_files)
+        total = len(pending_files)
+        pending_files, members = cluster_near_duplicates(
+            pending_files, args.near_dup_threshold, workers=args.hash_workers
+        )
+        print(f"Near-duplicate clustering: {len(pending_files)} clusters for {total} images")
+        write_fn = propagating_writer(members, write_fn, member_write_fn)
+    
+    # Peek so the model is only loaded when something is left to caption
+    pending_files = iter(dispatch(journal, pending_files))
+    first = next(pending_files, None)
+    pending_files = chain([first], pending_files)
+    
+    processed = 0
+    if first is None:
+        print("All captions are up to date")
+    elif args.server:
+        processed = run_client(args, pending_files, write_fn, log, on_error)
+    elif args.workers > 1:
+        processed = run_workers(args, pending_files, write_fn, log, on_error)
+    else:
+        processor, model = load_model(args.model, backend=args.backend, **backend_options(args))
+        processed = run_captioning(args, processor, model, pending_files, write_fn, log, on_error)
+    
+    if cache:
+        print(cache.report())
+        cache.close()
+    if journal is not None:
+        journal.finish()
+    
+    return processed
+
+def backend_options(args):
+    if args.backend == "cpu-fast":
+        return {
+            "dtype": args.cpu_dtype,
+            "threads": args.threads,
+            "interop_threads": args.interop_threads,
+            "use_compile": args.compile,
+        }
+    if args.backend == "onnx":
+        return {"threads": args.threads, "interop_threads": args.interop_threads}
+    return {}
+
+def dispatch(journal, image_files):
+    return journal.dispatch(image_files) if journal is not None else image_files
+
+def save_failed(image_file, error, on_error=None):
+    print(f"Error saving caption for {image_file.name}: {str(error)}")
+    if on_error is not None:
+        on_error(image_file, f"saving the caption failed: {str(error)}")
+
+def run_client(args, pending_files, write_fn, log=print, on_error=None):
+    from caption_client import CaptionClient
+    
+    client = CaptionClient(args.server)
+    print(f"Using caption server {args.server} ({client.health()['model']})")
+    
+    processed = 0
+    done = 0
+    for batch_files in batched(pending_files, max(1, args.concurrency) * 4):
+        captions = client.caption_many(batch_files, args.style, concurrency=args.concurrency, log=log,
+                                       on_error=on_error)
         
+        for image_file, caption in zip(batch_files, captions):
+            done += 1
+            if caption:
+                try:
+                    write_fn(image_file, caption)
+                    print(f"Saved caption for {image_file.name} ({done} done)")
+                    processed += 1
+                except Exception as e:
+                    save_failed(image_file, e, on_error)
+            else:
+                metrics.count("images_failed")
+    return processed
+
+def run_workers(args, pending_files, write_fn, log=print, on_error=None):
+    from workers import WorkerPool
+    
+    pool = WorkerPool(
+        args.model, args.style,
+        num_workers=args.workers,
+        batch_size=args.batch_size,
+        devices=[device.strip() for device in args.devices.split(",")] if args.devices else None,
+        threads_per_worker=args.threads_per_worker,
+        fast_load=args.fast_load,
+        backend=args.backend,
+        backend_options=backend_options(args),
+        log=log,
+        on_error=on_error,
+    )
+    processed = 0
+    done = 0
+    
+    def on_result(image_file, caption):
+        nonlocal processed, done
+        done += 1
         if caption:
             try:
-                with open(caption_file, 'w', encoding='utf-8') as f:
-                    f.write(caption)
-                print(f"Saved caption for {image_file.name}")
+                write_fn(image_file, caption)
+                print(f"Saved caption for {image_file.name} ({done} done)")
                 processed += 1
             except Exception as e:
-                print(f"Error saving caption for {image_file.name}: {str(e)}")
+                save_failed(image_file, e, on_error)
+        else:
+            metrics.count("images_failed")
+    
+    pool.run(pending_files, on_result)
+    return processed
+
+def run_multi_style(args, styles, pending_files, write_fn=write_caption, log=print, on_done=None, on_error=None):
+    from multi_style import FeatureStore, MultiStyleCaptioner, vision_modules
+    from prompt_cache import processor_revision
+    
+    processor, model = load_model(args.model, backend=args.backend, **backend_options(args))
+    target_size = get_target_size(processor) if args.fast_load else None
+    
+    feature_store = None
+    if args.feature_store:
+        vision_dtype = next(vision_modules(model)[1].parameters()).dtype
+        context = f"{args.model}:{processor_revision(processor)}:{target_size}:{args.backend}:{vision_dtype}"
+        feature_store = FeatureStore(args.feature_store, context)
+    
+    errors = {}
+    
+    def style_failed(image_file, error):
+        errors.setdefault(image_file, []).append(error)
+    
+    captioner = MultiStyleCaptioner(processor, model, styles, target_size=target_size, feature_store=feature_store, log=log,
+                                    on_error=style_failed)
+    processed = 0
+    done = 0
+    for batch_files in batched(pending_files, max(1, args.batch_size)):
+        for image_file in batch_files:
+            done += 1
+            print(f"Processing {done}: {image_file.name}")
+        
+        start_time = time.perf_counter()
+        results = captioner.caption_batch(batch_files)
+        seconds = (time.perf_counter() - start_time) / len(batch_files)
+        
+        for image_file in batch_files:
+            saved = 0
+            for style, caption in results[image_file].items():
+                if caption:
+                    try:
+                        write_fn(image_file, caption, style, seconds=seconds)
+                        saved += 1
+                    except Exception as e:
+                        print(f"Error saving {style} caption for {image_file.name}: {str(e)}")
+                        style_failed(image_file, f"saving the {style} caption failed: {str(e)}")
+            if saved:
+                print(f"Saved captions for {image_file.name}")
+                processed += 1
+            else:
+                metrics.count("images_failed")
+            if saved == len(styles):
+                if on_done:
+                    on_done(image_file)
+            elif on_error:
+                on_error(image_file, "; ".join(errors.get(image_file, ["no caption was produced for every style"])))
+            errors.pop(image_file, None)
+    
+    print(captioner.report())
+    if feature_store:
+        feature_store.close()
+    return processed
+
+def run_captioning(args, processor, model, pending_files, write_fn, log=print, on_error=None):
+    batch_size = max(1, args.batch_size)
+    target_size = get_target_size(processor) if args.fast_load else None
+    processed = 0
+    if args.continuous:
+        from continuous_batching import ContinuousBatchScheduler
+        
+        scheduler = ContinuousBatchScheduler(processor, model, args.style, num_slots=batch_size, log=log,
+                                             target_size=target_size, on_error=on_error)
+        for i, (image_file, caption) in enumerate(scheduler.run(pending_files), start=1):
+            if caption:
+                try:
+                    write_fn(image_file, caption)
+                    print(f"Saved caption for {image_file.name} ({i} done)")
+                    processed += 1
+                except Exception as e:
+                    save_failed(image_file, e, on_error)
+            else:
+                metrics.count("images_failed")
+        print(scheduler.utilization_report())
+    elif args.pipeline:
+        from pipeline import CaptionPipeline
+        
+        pipeline = CaptionPipeline(
+            processor, model, args.style,
+            batch_size=batch_size,
+            num_readers=args.readers,
+            num_preprocessors=args.preprocess_workers,
+            read_queue_depth=args.queue_depth,
+            preprocess_queue_depth=args.queue_depth,
+            write_queue_depth=args.queue_depth * 4,
+            write_fn=write_fn,
+            log=log,
+            target_size=target_size,
+            on_error=on_error,
+        )
+        done = 0
+        
+        def on_result(image_file, caption):
+            nonlocal done
+            done += 1
+            if caption:
+                print(f"Captioned {done}: {image_file.name}")
+            else:
+                metrics.count("images_failed")
+        
+        results = pipeline.run(pending_files, on_result=on_result)
+        processed = results["saved"]
+        print(pipeline.report())
+    else:
+        done = 0
+        for batch_files in batched(pending_files, batch_size):
+            for image_file in batch_files:
+                done += 1
+                print(f"Processing {done}: {image_file.name}")
+            
+            start_time = time.perf_counter()
+            captions = caption_images(processor, model, batch_files, args.style, log=log, target_size=target_size,
+                                      on_error=on_error)
+            seconds = (time.perf_counter() - start_time) / len(batch_files)
+            
+            for image_file, caption in zip(batch_files, captions):
+                if caption:
+                    try:
+                        write_fn(image_file, caption, seconds=seconds)
+                        print(f"Saved caption for {image_file.name}")
+                        processed += 1
+                    except Exception as e:
+                        save_failed(image_file, e, on_error)
+                else:
+                    metrics.count("images_failed")
     
-    print(f"Processing completed! Captioned {processed} images")
+    return processed
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,338 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+from argparse import Namespace
+from pathlib import Path
+
+import numpy as np
+import torch
+import transformers
+from PIL import Image
+
+from batch_caption import BACKENDS, CAPTION_STYLES, load_model, run_captioning
+from sources import iter_images
+
+BENCHMARK_MODES = ["batch", "pipeline", "continuous"]
+CORPUS_SIZES = [(256, 256), (640, 480), (1024, 768), (1920, 1080), (4032, 3024)]
+CORPUS_FORMATS = ["jpg", "png", "webp", "bmp"]
+PIL_FORMATS = {"jpg": "JPEG", "png": "PNG", "webp": "WEBP", "bmp": "BMP"}
+
+
+def synthetic_image(width, height, rng):
+    """A gradient with blocks of texture and noise, so images compress and decode roughly like photos."""
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    colors = rng.random((2, 3), dtype=np.float32) * 255
+    pixels = (1 - x) * colors[0] + x * colors[1] + 40 * y
+    for _ in range(8):
+        left, top = int(rng.integers(0, width)), int(rng.integers(0, height))
+        right, bottom = left + int(rng.integers(1, width // 3 + 2)), top + int(rng.integers(1, height // 3 + 2))
+        pixels[top:bottom, left:right] = rng.random(3, dtype=np.float32) * 255
+    pixels += rng.normal(0, 12, pixels.shape).astype(np.float32)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def make_corpus(folder, count=64, sizes=CORPUS_SIZES, formats=CORPUS_FORMATS, seed=0):
+    """Write count synthetic images to folder, cycling through every size and format combination.
+
+    A manifest records the parameters and the files written, so a folder built with the same
+    parameters is reused as is and a stale corpus is replaced without touching anything else.
+    Folders holding files that no manifest accounts for are refused.
+    """
+    folder = Path(folder)
+    spec = {"count": count, "sizes": [list(size) for size in sizes], "formats": list(formats), "seed": seed}
+    manifest = folder / "corpus.json"
+    old_files = []
+    if manifest.exists():
+        corpus = json.loads(manifest.read_text(encoding="utf-8"))
+        old_files = corpus.get("files", [])
+        if corpus.get("spec") == spec:
+            return {"spec": corpus["spec"], "bytes": corpus["bytes"]}
+
+    folder.mkdir(parents=True, exist_ok=True)
+    unknown = [path.name for path in folder.iterdir() if path.name not in old_files and path != manifest]
+    if unknown:
+        raise ValueError(f"{folder} is not a benchmark corpus folder (found {unknown[0]}); "
+                         "use an empty folder for --corpus")
+    for name in old_files:
+        (folder / name).unlink(missing_ok=True)
+    rng = np.random.default_rng(seed)
+    combinations = [(size, fmt) for size in sizes for fmt in formats]
+    random.Random(seed).shuffle(combinations)
+    total_bytes = 0
+    files = []
+    for i in range(count):
+        (width, height), fmt = combinations[i % len(combinations)]
+        path = folder / f"img{i:05d}_{width}x{height}.{fmt}"
+        synthetic_image(width, height, rng).save(path, PIL_FORMATS[fmt])
+        total_bytes += path.stat().st_size
+        files.append(path.name)
+
+    manifest.write_text(json.dumps({"spec": spec, "bytes": total_bytes, "files": files}, indent=2), encoding="utf-8")
+    return {"spec": spec, "bytes": total_bytes}
+
+
+class RssSampler:
+    """Track the peak resident set size of this process while a block of code runs.
+
+    Samples with psutil in a background thread. Without psutil it falls back to the process
+    lifetime peak from getrusage, which cannot go down between runs.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        try:
+            import psutil
+            self.process = psutil.Process()
+        except ImportError:
+            self.process = None
+
+    def _sample(self):
+        while not self.stop_event.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def __enter__(self):
+        if self.process is not None:
+            self.peak = self.process.memory_info().rss
+            self.thread = threading.Thread(target=self._sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.peak = max(self.peak, self.process.memory_info().rss)
+        else:
+            import resource
+            # ru_maxrss is in kilobytes on Linux and bytes on macOS
+            scale = 1 if platform.system() == "Darwin" else 1024
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        return False
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def benchmark_run(processor, model, image_files, output_dir, mode="batch", batch_size=1, style="training",
+                  fast_load=False, readers=2, preprocess_workers=2, queue_depth=8, seed=0):
+    """Caption image_files through the regular folder loop and measure it.
+
+    Captions are written to output_dir rather than next to the images, so benchmarking a real
+    dataset never touches its caption files. Per-image latency runs from the moment the loop takes
+    an image from its input to the moment its caption is written, so batching and queueing delays
+    are included. Tokens are counted by re-tokenizing the captions, which works the same way for
+    every mode and backend.
+    """
+    args = Namespace(batch_size=batch_size, fast_load=fast_load, continuous=mode == "continuous",
+                     pipeline=mode == "pipeline", style=style, readers=readers,
+                     preprocess_workers=preprocess_workers, queue_depth=queue_depth)
+    taken = {}
+    latencies = []
+    tokens = 0
+
+    def timed(files):
+        for image_file in files:
+            taken[image_file] = time.perf_counter()
+            yield image_file
+
+    def write_fn(image_file, caption, style=None, **info):
+        nonlocal tokens
+        with open(Path(output_dir) / f"{len(latencies):06d}.txt", 'w', encoding='utf-8') as f:
+            f.write(caption)
+        latencies.append(time.perf_counter() - taken[image_file])
+        tokens += len(processor.tokenizer(caption, add_special_tokens=False)["input_ids"])
+
+    torch.manual_seed(seed)
+    with RssSampler() as rss, contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        captioned = run_captioning(args, processor, model, timed(image_files), write_fn, log=lambda message: None)
+        seconds = time.perf_counter() - start
+
+    return {
+        "mode": mode,
+        "batch_size": batch_size,
+        "images": len(image_files),
+        "captioned": captioned,
+        "seconds": round(seconds, 4),
+        "images_per_sec": round(captioned / seconds, 4),
+        "latency_p50": round(percentile(latencies, 50), 4) if latencies else None,
+        "latency_p95": round(percentile(latencies, 95), 4) if latencies else None,
+        "tokens": tokens,
+        "tokens_per_sec": round(tokens / seconds, 2),
+        "peak_rss_mb": round(rss.peak / 2**20, 1),
+    }
+
+
+def environment():
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "cuda": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        "torch_threads": torch.get_num_threads(),
+    }
+
+
+def run_key(run):
+    return f"{run['mode']}/batch{run['batch_size']}"
+
+
+def compare(results, baseline, max_regression=None):
+    """Print throughput and latency changes against a previous results file.
+
+    Returns the runs whose images/sec dropped by more than max_regression (a fraction).
+    """
+    previous = {run_key(run): run for run in baseline["runs"]}
+    regressions = []
+    for run in results["runs"]:
+        old = previous.get(run_key(run))
+        if old is None:
+            print(f"{run_key(run)}: not in baseline")
+            continue
+        change = run["images_per_sec"] / old["images_per_sec"] - 1 if old["images_per_sec"] else 0.0
+        print(f"{run_key(run)}: {old['images_per_sec']:.2f} -> {run['images_per_sec']:.2f} images/sec ({change:+.1%}), "
+              f"p95 {old['latency_p95']} -> {run['latency_p95']}s, "
+              f"peak RSS {old['peak_rss_mb']} -> {run['peak_rss_mb']} MB")
+        if max_regression is not None and change < -max_regression:
+            regressions.append(run_key(run))
+    return regressions
+
+
+def prepare_model(model_path, backend, work_dir):
+    """Return the model path to benchmark, building (and for onnx exporting) a tiny model when none is given."""
+    if model_path:
+        return model_path
+    from tiny_llava import build_tiny_llava
+
+    model_path = build_tiny_llava(str(Path(work_dir) / "tiny-llava"))
+    if backend == "onnx":
+        from onnx_backend import export_onnx
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            model_path = export_onnx(model_path, str(Path(work_dir) / "tiny-llava-onnx"))
+    return model_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark captioning throughput, latency and memory")
+    parser.add_argument("--model",
+                       help="Path to the model to benchmark; defaults to a tiny random-weight model built locally")
+    parser.add_argument("--backend", choices=list(BACKENDS), default="default",
+                       help="Model backend")
+    parser.add_argument("--corpus",
+                       help="Folder for the synthetic image corpus, reused when it matches; defaults to a temporary folder")
+    parser.add_argument("--images",
+                       help="Benchmark an existing image folder instead of a synthetic corpus")
+    parser.add_argument("--count", type=int, default=64,
+                       help="Number of synthetic images")
+    parser.add_argument("--sizes", default=",".join(f"{w}x{h}" for w, h in CORPUS_SIZES),
+                       help="Comma separated synthetic image sizes, e.g. 640x480,1920x1080")
+    parser.add_argument("--formats", default=",".join(CORPUS_FORMATS),
+                       help="Comma separated synthetic image formats")
+    parser.add_argument("--modes", default="batch,pipeline",
+                       help=f"Comma separated folder loop modes to run: {', '.join(BENCHMARK_MODES)}")
+    parser.add_argument("--batch-sizes", default="1,4",
+                       help="Comma separated batch sizes run for every mode")
+    parser.add_argument("--style", choices=CAPTION_STYLES, default="training",
+                       help="Caption style")
+    parser.add_argument("--fast-load", action="store_true",
+                       help="Decode large images at reduced resolution")
+    parser.add_argument("--threads", type=int, default=None,
+                       help="Intra-op threads")
+    parser.add_argument("--seed", type=int, default=0,
+                       help="Seed for the corpus and caption sampling")
+    parser.add_argument("--output", default="benchmark.json",
+                       help="JSON file the results are written to")
+    parser.add_argument("--compare",
+                       help="Previous results JSON to compare against")
+    parser.add_argument("--max-regression", type=float, default=None,
+                       help="Exit with an error when images/sec drops by more than this fraction against --compare")
+
+    args = parser.parse_args()
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    unknown = [mode for mode in modes if mode not in BENCHMARK_MODES]
+    if unknown:
+        parser.error(f"unknown modes: {', '.join(unknown)}")
+    if args.backend == "onnx" and "continuous" in modes:
+        parser.error("--backend onnx cannot run the continuous mode")
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",") if size.strip()]
+    sizes = [tuple(int(n) for n in size.lower().split("x")) for size in args.sizes.split(",") if size.strip()]
+    formats = [fmt.strip().lower() for fmt in args.formats.split(",") if fmt.strip()]
+    unknown = [fmt for fmt in formats if fmt not in PIL_FORMATS]
+    if unknown:
+        parser.error(f"unknown formats: {', '.join(unknown)}")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        model_path = prepare_model(args.model, args.backend, work_dir)
+        if args.images:
+            image_files = list(iter_images(args.images))
+            corpus = {"folder": str(args.images)}
+        else:
+            corpus_folder = args.corpus or str(Path(work_dir) / "corpus")
+            print(f"Preparing {args.count} synthetic images in {corpus_folder}")
+            try:
+                corpus = make_corpus(corpus_folder, args.count, sizes, formats, args.seed)
+            except ValueError as e:
+                parser.error(str(e))
+            image_files = list(iter_images(corpus_folder))
+        print(f"Benchmarking {len(image_files)} images")
+
+        options = {"threads": args.threads} if args.backend != "default" else {}
+        start = time.perf_counter()
+        with RssSampler() as rss, contextlib.redirect_stdout(io.StringIO()):
+            processor, model = load_model(model_path, backend=args.backend, **options)
+        load = {"seconds": round(time.perf_counter() - start, 3), "peak_rss_mb": round(rss.peak / 2**20, 1)}
+
+        # One untimed caption so lazy initialization does not land in the first run
+        benchmark_run(processor, model, image_files[:1], work_dir, style=args.style)
+
+        runs = []
+        for mode in modes:
+            for batch_size in batch_sizes:
+                run = benchmark_run(processor, model, image_files, work_dir, mode, batch_size, args.style,
+                                    fast_load=args.fast_load, seed=args.seed)
+                runs.append(run)
+                print(f"{run_key(run)}: {run['images_per_sec']:.2f} images/sec, "
+                      f"p50 {run['latency_p50']}s, p95 {run['latency_p95']}s, "
+                      f"{run['tokens_per_sec']:.1f} tokens/sec, peak RSS {run['peak_rss_mb']} MB")
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "model": args.model or "tiny-llava",
+        "backend": args.backend,
+        "style": args.style,
+        "fast_load": args.fast_load,
+        "environment": environment(),
+        "corpus": corpus,
+        "load": load,
+        "runs": runs,
+    }
+    Path(args.output).write_text(json.dumps(results, indent=2), encoding="utf-8")
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            raise SystemExit(f"Throughput regressed by more than {args.max_regression:.1%}: {', '.join(regressions)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from metrics import metrics
+from sources import open_file
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open_file(path) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_fingerprint(model_path, max_hashed_size=64 << 20):
+    """Identify the model a path points at, so renamed paths share a cache and replaced weights do not.
+
+    For a local folder (or a hub id found in the Hugging Face cache) this is the resolved folder
+    plus its files: configs, tokenizer and processor files by content, weight files by size and
+    modification time, since hashing gigabytes of weights would cost more than most runs save.
+    """
+    folder = Path(model_path)
+    if not folder.is_dir():
+        try:
+            from huggingface_hub import try_to_load_from_cache
+            cached = try_to_load_from_cache(str(model_path), "config.json")
+        except Exception:
+            cached = None
+        if not isinstance(cached, str):
+            return str(model_path)
+        folder = Path(cached).parent
+
+    digest = hashlib.sha256(str(folder.resolve()).encode("utf-8"))
+    for path in sorted(folder.rglob("*")):
+        relative = path.relative_to(folder)
+        # Skip .git and similar, which change without the model changing
+        if not path.is_file() or any(part.startswith(".") for part in relative.parts):
+            continue
+        stat = path.stat()
+        digest.update(f"\n{relative.as_posix()}:{stat.st_size}:".encode("utf-8"))
+        if stat.st_size <= max_hashed_size:
+            digest.update(path.read_bytes())
+        else:
+            digest.update(str(stat.st_mtime_ns).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def cache_context(model_path, style, prompt, generation_kwargs, backend="default", backend_options=None):
+    """Identify everything besides the image that decides the caption."""
+    # Thread counts change speed, not captions, so they do not split the cache
+    options = {k: v for k, v in (backend_options or {}).items() if k not in ("threads", "interop_threads")}
+    context = {
+        "model": model_fingerprint(model_path),
+        "style": style,
+        "prompt": prompt,
+        "generation": generation_kwargs,
+        "backend": backend,
+        "backend_options": options,
+    }
+    return hashlib.sha256(json.dumps(context, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class CaptionCache:
+    """Persistent caption cache keyed by image content hash and caption context.
+
+    Captions live in a local SQLite database, so moving or renaming a dataset still hits the
+    cache. When max_entries is set, the least recently used captions are evicted. Hits only
+    record their use time in memory and are written in batches of touch_batch, so serving a
+    mostly cached folder does not cost one synced commit per image.
+    """
+
+    def __init__(self, db_path, max_entries=None, touch_batch=256):
+        self.db_path = Path(db_path)
+        self.max_entries = max_entries
+        self.touch_batch = touch_batch
+        self.touched = {}
+        self.hits = 0
+        self.misses = 0
+        self.duplicates = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            "key TEXT PRIMARY KEY, caption TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS captions_last_used ON captions (last_used)")
+        self.conn.commit()
+        self.entries = self.conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+
+    @staticmethod
+    def key(image_hash, context):
+        return f"{image_hash}:{context}"
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT caption FROM captions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.count("caption_cache_misses")
+                return None
+            self.hits += 1
+            metrics.count("caption_cache_hits")
+            self.touched[key] = time.time()
+            if len(self.touched) >= self.touch_batch:
+                self._write_touched()
+                self.conn.commit()
+            return row[0]
+
+    def put(self, key, caption):
+        now = time.time()
+        with self.lock:
+            # Pending use times go in first, so eviction sees every recent hit
+            self._write_touched()
+            inserted = self.conn.execute(
+                "INSERT OR IGNORE INTO captions (key, caption, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, caption, now, now),
+            ).rowcount
+            if inserted:
+                self.entries += 1
+            else:
+                self.conn.execute("UPDATE captions SET caption = ?, last_used = ? WHERE key = ?", (caption, now, key))
+            self._evict()
+            self.conn.commit()
+
+    def flush(self):
+        """Write the use times of recent hits."""
+        with self.lock:
+            self._write_touched()
+            self.conn.commit()
+
+    def _write_touched(self):
+        if self.touched:
+            self.conn.executemany("UPDATE captions SET last_used = ? WHERE key = ?",
+                                  [(used, key) for key, used in self.touched.items()])
+            self.touched.clear()
+
+    def _evict(self):
+        if not self.max_entries:
+            return
+        excess = self.entries - self.max_entries
+        if excess > 0:
+            evicted = self.conn.execute(
+                "DELETE FROM captions WHERE key IN (SELECT key FROM captions ORDER BY last_used LIMIT ?)",
+                (excess,),
+            ).rowcount
+            self.entries -= evicted
+            self.evictions += evicted
+            metrics.count("caption_cache_evictions", evicted)
+
+    def __len__(self):
+        return self.entries
+
+    def plan(self, image_files, context, write_fn, log=print):
+        """Serve cache hits and collapse byte-identical images.
+
+        Hits are written with write_fn right away. Returns (files_to_caption, keys, duplicates),
+        where keys maps each file to its cache key and duplicates maps a file that still needs a
+        caption to the other files with the same content.
+        """
+        to_caption = []
+        keys = {}
+        duplicates = {}
+        first_by_key = {}
+        for image_file in image_files:
+            try:
+                with metrics.stage("hash"):
+                    key = self.key(hash_file(image_file), context)
+            except OSError as e:
+                log(f"Error hashing {image_file}: {str(e)}")
+                to_caption.append(image_file)
+                continue
+            keys[image_file] = key
+
+            if key in first_by_key:
+                self.duplicates += 1
+                metrics.count("caption_cache_duplicates")
+                duplicates[first_by_key[key]].append(image_file)
+                continue
+
+            caption = self.get(key)
+            if caption is not None:
+                try:
+                    write_fn(image_file, caption)
+                    log(f"Cached caption for {image_file.name}")
+                except Exception as e:
+                    log(f"Error saving caption for {image_file.name}: {str(e)}")
+                continue
+
+            first_by_key[key] = image_file
+            duplicates[image_file] = []
+            to_caption.append(image_file)
+        self.flush()
+        return to_caption, keys, duplicates
+
+    def writer(self, keys, duplicates, write_fn, store=True):
+        """Wrap write_fn so a new caption is also written to duplicates and stored in the cache.
+
+        With store=False captions are only copied to duplicates, for captions the model did not
+        generate for that image's content.
+        """
+        def write(image_file, caption, **info):
+            write_fn(image_file, caption, **info)
+            for duplicate in duplicates.get(image_file, ()):
+                write_fn(duplicate, caption, **info)
+            key = keys.get(image_file)
+            if store and key is not None:
+                self.put(key, caption)
+        return write
+
+    def report(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        return (f"Caption cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), "
+                f"{self.duplicates} duplicates captioned once, {self.evictions} evictions, {len(self)} entries")
+
+    def close(self):
+        with self.lock:
+            self._write_touched()
+            self.conn.commit()
+            self.conn.close()
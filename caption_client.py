@@ -0,0 +1,67 @@
+import base64
+import json
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+
+class CaptionClient:
+    """Thin client for a running caption_server daemon; needs neither torch nor the model."""
+
+    def __init__(self, url=DEFAULT_URL, timeout=600):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, route, payload=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(
+            f"{self.url}{route}",
+            data=data,
+            headers={"Content-Type": "application/json"},
+            method="POST" if data is not None else "GET",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            body = json.loads(e.read().decode("utf-8") or "{}")
+            raise RuntimeError(body.get("error", str(e))) from None
+
+    def health(self):
+        return self._request("/health")
+
+    def stats(self):
+        return self._request("/stats")
+
+    def caption(self, image_path=None, style="descriptive", image_bytes=None):
+        """Caption a local file by path (read by the daemon) or raw image bytes."""
+        payload = {"style": style}
+        if image_bytes is not None:
+            payload["image"] = base64.b64encode(image_bytes).decode("ascii")
+        else:
+            payload["path"] = str(Path(image_path).resolve())
+        return self._request("/caption", payload)["caption"]
+
+    def caption_many(self, image_paths, style="descriptive", concurrency=8, log=print, on_error=None):
+        """Caption several files concurrently so the daemon can batch them.
+
+        None marks a failure, which is also reported as on_error(image_path, error).
+        """
+        def caption_one(image_path):
+            try:
+                if isinstance(image_path, (str, Path)):
+                    return self.caption(image_path, style)
+                # Images inside shards are not files the daemon can open, so send their bytes
+                with image_path.open() as f:
+                    return self.caption(style=style, image_bytes=f.read())
+            except Exception as e:
+                log(f"Error captioning {image_path}: {str(e)}")
+                if on_error is not None:
+                    on_error(image_path, str(e))
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            return list(executor.map(caption_one, image_paths))
@@ -0,0 +1,204 @@
+import argparse
+import base64
+import io
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from batch_caption import BACKENDS, CAPTION_STYLES, generate_captions, get_target_size, load_image, load_model
+from caption_client import DEFAULT_URL
+from metrics import metrics
+
+
+class CaptionRequest:
+    def __init__(self, image, style):
+        self.image = image
+        self.style = style
+        self.caption = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class DynamicBatcher:
+    """Coalesce concurrent caption requests into batched generate calls.
+
+    After the first request of a batch arrives, the batcher waits at most max_wait seconds for
+    more requests, up to max_batch_size, then captions them per style in one generate call.
+    """
+
+    def __init__(self, processor, model, max_batch_size=8, max_wait=0.05, log=print):
+        self.processor = processor
+        self.model = model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.log = log
+        self.requests = queue.Queue()
+        self.batches = 0
+        self.captioned = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image, style):
+        request = CaptionRequest(image, style)
+        self.requests.put(request)
+        metrics.gauge("queue_depth", self.requests.qsize(), queue="requests")
+        return request
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        metrics.gauge("queue_depth", self.requests.qsize(), queue="requests")
+        metrics.observe("batch_size", len(batch))
+        return batch
+
+    def _caption(self, requests):
+        try:
+            captions = generate_captions(self.processor, self.model, [r.image for r in requests], requests[0].style)
+        except Exception as e:
+            if len(requests) == 1:
+                requests[0].error = str(e)
+                metrics.count("images_failed")
+                return
+            # Retry one at a time so one bad input does not fail the whole batch
+            for request in requests:
+                self._caption([request])
+            return
+        for request, caption in zip(requests, captions):
+            request.caption = caption
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            by_style = {}
+            for request in batch:
+                by_style.setdefault(request.style, []).append(request)
+            for requests in by_style.values():
+                self._caption(requests)
+                self.batches += 1
+                self.captioned += len(requests)
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "captioned": self.captioned,
+            "mean_batch_size": self.captioned / self.batches if self.batches else 0.0,
+            "queued": self.requests.qsize(),
+        }
+
+
+class CaptionHandler(BaseHTTPRequestHandler):
+    server_version = "JoyCaptionServer/1.0"
+
+    def _reply(self, status, body, content_type="application/json"):
+        data = body.encode("utf-8") if isinstance(body, str) else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._reply(200, {"status": "ok", "model": self.server.model_path})
+        elif self.path == "/stats":
+            self._reply(200, self.server.batcher.stats())
+        elif self.path == "/metrics":
+            self._reply(200, metrics.prometheus(), "text/plain; version=0.0.4")
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/caption":
+            self._reply(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length).decode("utf-8"))
+            style = payload.get("style", "descriptive")
+            if style not in CAPTION_STYLES:
+                raise ValueError(f"unknown style: {style}")
+            if "image" in payload:
+                source = io.BytesIO(base64.b64decode(payload["image"]))
+            elif "path" in payload:
+                source = payload["path"]
+            else:
+                raise ValueError("request needs either 'path' or 'image'")
+            image = load_image(source, self.server.target_size)
+        except Exception as e:
+            self._reply(400, {"error": str(e)})
+            return
+
+        request = self.server.batcher.submit(image, style)
+        request.done.wait()
+        if request.error is not None:
+            self._reply(500, {"error": request.error})
+        else:
+            self._reply(200, {"caption": request.caption})
+
+
+def serve(model_path, host="127.0.0.1", port=8765, max_batch_size=8, max_wait=0.05, fast_load=False, verbose=False,
+          backend="default", **backend_options):
+    # Always on in the daemon so /metrics can be scraped; tracing stays off
+    metrics.enable()
+    processor, model = load_model(model_path, backend=backend, **backend_options)
+
+    server = ThreadingHTTPServer((host, port), CaptionHandler)
+    server.daemon_threads = True
+    server.model_path = model_path
+    server.verbose = verbose
+    server.target_size = get_target_size(processor) if fast_load else None
+    server.batcher = DynamicBatcher(processor, model, max_batch_size=max_batch_size, max_wait=max_wait)
+
+    print(f"Caption server listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve JoyCaption captions from a long-lived local process")
+    parser.add_argument("--model", default="llama-joycaption-beta-one-hf-llava",
+                       help="Path to JoyCaption model")
+    parser.add_argument("--host", default="127.0.0.1",
+                       help="Address to bind, localhost only by default")
+    parser.add_argument("--port", type=int, default=int(DEFAULT_URL.rsplit(":", 1)[1]),
+                       help="Port to listen on")
+    parser.add_argument("--max-batch-size", type=int, default=8,
+                       help="Largest batch of coalesced requests")
+    parser.add_argument("--max-wait-ms", type=float, default=50,
+                       help="How long the first request of a batch waits for others")
+    parser.add_argument("--fast-load", action="store_true",
+                       help="Decode large images at reduced resolution before preprocessing")
+    parser.add_argument("--verbose", action="store_true",
+                       help="Log every HTTP request")
+    parser.add_argument("--backend", choices=list(BACKENDS), default="default",
+                       help="cpu-fast: int8 language model for machines without a GPU; onnx: ONNX Runtime export")
+    parser.add_argument("--threads", type=int, default=None,
+                       help="Intra-op threads for --backend cpu-fast or onnx")
+
+    args = parser.parse_args()
+    backend_options = {"threads": args.threads} if args.backend != "default" else {}
+    serve(args.model, args.host, args.port, args.max_batch_size, args.max_wait_ms / 1000, args.fast_load, args.verbose,
+          args.backend, **backend_options)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+import torch
+from transformers import DynamicCache
+
+from batch_caption import GENERATION_KWARGS, get_prompt_cache, load_image, prepare_inputs, record_tokens
+from metrics import metrics
+
+
+def sample_next_tokens(logits, do_sample=True, temperature=0.6, top_p=0.9, top_k=None):
+    if not do_sample:
+        return logits.argmax(dim=-1)
+
+    logits = logits.float() / max(temperature, 1e-5)
+    if top_k:
+        kth = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+    if top_p is not None and top_p < 1.0:
+        cumulative = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        # Keep the smallest prefix whose probability mass reaches top_p, always including the best token
+        remove = cumulative > top_p
+        remove[:, 1:] = remove[:, :-1].clone()
+        remove[:, 0] = False
+        sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+
+    choice = torch.multinomial(sorted_logits.softmax(dim=-1), num_samples=1)
+    return sorted_indices.gather(-1, choice).squeeze(-1)
+
+
+def cache_layers(cache):
+    """Return the cached (key, value) tensors per layer for both old and new transformers cache layouts."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(k, v) for k, v in cache]
+
+
+def build_cache(layers):
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(layers):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+def left_pad(tensor, length, dim):
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    pad_shape = list(tensor.shape)
+    pad_shape[dim] = missing
+    return torch.cat([tensor.new_zeros(pad_shape), tensor], dim=dim)
+
+
+class ContinuousBatchScheduler:
+    """Caption images with a fixed number of generation slots.
+
+    Unlike a static batch, a sequence is evicted as soon as it emits EOS (or hits max_new_tokens)
+    and the next image from the queue is prefilled into the free slot, so short captions
+    never wait for the longest caption of their batch.
+    """
+
+    def __init__(self, processor, model, style="descriptive", num_slots=4, log=print, target_size=None,
+                 use_prefix_cache=True, on_error=None, **generation_kwargs):
+        self.processor = processor
+        self.model = model
+        self.style = style
+        self.num_slots = max(1, num_slots)
+        self.log = log
+        self.on_error = on_error
+        self.target_size = target_size
+        self.use_prefix_cache = use_prefix_cache
+
+        settings = dict(GENERATION_KWARGS)
+        settings.update(generation_kwargs)
+        self.max_new_tokens = settings["max_new_tokens"]
+        self.do_sample = settings["do_sample"]
+        self.temperature = settings["temperature"]
+        self.top_p = settings["top_p"]
+        self.top_k = settings["top_k"]
+        self.eos_token_ids = self._eos_token_ids()
+
+        self.reset_stats()
+
+    def _eos_token_ids(self):
+        eos = getattr(self.model.generation_config, "eos_token_id", None)
+        if eos is None:
+            eos = self.processor.tokenizer.eos_token_id
+        if eos is None:
+            return set()
+        return set(eos) if isinstance(eos, (list, tuple)) else {eos}
+
+    def reset_stats(self):
+        self.steps = 0
+        self.slot_active_steps = [0] * self.num_slots
+        self.caption_lengths = []
+
+    def _clear_batch(self):
+        # Parallel per-row state, one entry per occupied slot
+        self.rows = []
+        self.cache = None
+        self.attention_mask = None
+        self.next_tokens = None
+        self.positions = None
+
+    def _free_slots(self):
+        used = {row["slot"] for row in self.rows}
+        return [slot for slot in range(self.num_slots) if slot not in used]
+
+    def _prefill(self, images):
+        inputs = prepare_inputs(self.processor, images, self.style)
+        attention_mask = inputs["attention_mask"]
+        position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+
+        prefix = None
+        if self.use_prefix_cache and bool(attention_mask.all()):
+            prefix = get_prompt_cache(self.processor).prefix(self.model, self.style, inputs["input_ids"], cache_layers)
+
+        with metrics.stage("prefill", batch=len(images)), torch.no_grad():
+            if prefix is None:
+                outputs = self.model(
+                    **inputs,
+                    position_ids=position_ids,
+                    use_cache=True,
+                )
+            else:
+                # Start from the cached system/user prefix and only prefill the image tokens and the suffix
+                layers, length = prefix
+                batch_size = attention_mask.shape[0]
+                cache = build_cache([
+                    (k.expand(batch_size, -1, -1, -1).contiguous(), v.expand(batch_size, -1, -1, -1).contiguous())
+                    for k, v in layers
+                ])
+                suffix = {k: v for k, v in inputs.items() if k not in ("input_ids", "attention_mask")}
+                outputs = self.model(
+                    input_ids=inputs["input_ids"][:, length:],
+                    attention_mask=attention_mask,
+                    position_ids=position_ids[:, length:],
+                    past_key_values=cache,
+                    use_cache=True,
+                    **suffix,
+                )
+
+        first_tokens = sample_next_tokens(
+            outputs.logits[:, -1, :], self.do_sample, self.temperature, self.top_p, self.top_k
+        )
+        return outputs.past_key_values, attention_mask, first_tokens, attention_mask.sum(-1)
+
+    def _merge(self, cache, attention_mask, next_tokens, positions):
+        """Append freshly prefilled rows to the running batch, left padding the shorter side."""
+        if self.cache is None:
+            self.cache = cache
+            self.attention_mask = attention_mask
+            self.next_tokens = next_tokens
+            self.positions = positions
+            return
+
+        length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+        layers = []
+        for (old_k, old_v), (new_k, new_v) in zip(cache_layers(self.cache), cache_layers(cache)):
+            layers.append((
+                torch.cat([left_pad(old_k, length, -2), left_pad(new_k, length, -2)], dim=0),
+                torch.cat([left_pad(old_v, length, -2), left_pad(new_v, length, -2)], dim=0),
+            ))
+        self.cache = build_cache(layers)
+        self.attention_mask = torch.cat(
+            [left_pad(self.attention_mask, length, 1), left_pad(attention_mask, length, 1)], dim=0
+        )
+        self.next_tokens = torch.cat([self.next_tokens, next_tokens])
+        self.positions = torch.cat([self.positions, positions])
+
+    def _evict(self, finished):
+        keep = [i for i in range(len(self.rows)) if i not in finished]
+        self.rows = [self.rows[i] for i in keep]
+        if not keep:
+            self._clear_batch()
+            return
+
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # Drop leading columns that are padding for every remaining row
+        start = int((attention_mask.sum(0) == 0).long().cumprod(0).sum())
+        layers = [
+            (k.index_select(0, index.to(k.device))[:, :, start:], v.index_select(0, index.to(v.device))[:, :, start:])
+            for k, v in cache_layers(self.cache)
+        ]
+        self.cache = build_cache(layers)
+        self.attention_mask = attention_mask[:, start:]
+        self.next_tokens = self.next_tokens.index_select(0, index.to(self.next_tokens.device))
+        self.positions = self.positions.index_select(0, index.to(self.positions.device))
+
+    def _fail(self, image_path, error):
+        self.log(f"Error captioning {image_path}: {str(error)}")
+        if self.on_error:
+            self.on_error(image_path, str(error))
+
+    def _admit(self, queue):
+        free_slots = self._free_slots()
+        admitted = []
+        while len(admitted) < len(free_slots):
+            image_path = next(queue, None)
+            if image_path is None:
+                break
+            try:
+                image = load_image(image_path, self.target_size)
+            except Exception as e:
+                self._fail(image_path, e)
+                yield image_path, None
+                continue
+            admitted.append((image_path, image))
+
+        if not admitted:
+            return
+
+        try:
+            groups = [(admitted, self._prefill([image for _, image in admitted]))]
+        except Exception:
+            # Prefill one image at a time so a single bad input does not fail the others
+            groups = []
+            for item in admitted:
+                try:
+                    groups.append(([item], self._prefill([item[1]])))
+                except Exception as e:
+                    self._fail(item[0], e)
+                    yield item[0], None
+
+        for items, prefilled in groups:
+            self._merge(*prefilled)
+            for image_path, _ in items:
+                self.rows.append({"slot": free_slots.pop(0), "path": image_path, "tokens": []})
+
+    def _step(self):
+        """Record the pending token of every row, then run one decode step for the rows still active."""
+        finished = []
+        results = []
+        tokens = self.next_tokens.tolist()
+        for i, (row, token) in enumerate(zip(self.rows, tokens)):
+            self.slot_active_steps[row["slot"]] += 1
+            if token in self.eos_token_ids:
+                finished.append(i)
+                continue
+            row["tokens"].append(token)
+            if len(row["tokens"]) >= self.max_new_tokens:
+                finished.append(i)
+        self.steps += 1
+
+        for i in finished:
+            row = self.rows[i]
+            with metrics.stage("detokenize"):
+                caption = self.processor.tokenizer.decode(
+                    row["tokens"], skip_special_tokens=True, clean_up_tokenization_spaces=False
+                )
+            self.caption_lengths.append(len(row["tokens"]))
+            results.append((row["path"], caption.strip()))
+        if finished:
+            record_tokens([len(self.rows[i]["tokens"]) for i in finished])
+            self._evict(set(finished))
+        metrics.gauge("active_slots", len(self.rows))
+        return results
+
+    def _decode(self):
+        past_length = self.attention_mask.shape[1]
+        self.attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((len(self.rows), 1))], dim=1)
+
+        with metrics.stage("generate", batch=len(self.rows)), torch.no_grad():
+            outputs = self.model(
+                input_ids=self.next_tokens[:, None],
+                attention_mask=self.attention_mask,
+                position_ids=self.positions[:, None],
+                past_key_values=self.cache,
+                cache_position=torch.arange(past_length, past_length + 1, device=self.attention_mask.device),
+                use_cache=True,
+            )
+
+        self.cache = outputs.past_key_values
+        self.positions = self.positions + 1
+        self.next_tokens = sample_next_tokens(
+            outputs.logits[:, -1, :], self.do_sample, self.temperature, self.top_p, self.top_k
+        )
+
+    def run(self, image_paths):
+        """Yield (image_path, caption) as each caption finishes; caption is None on failure.
+
+        image_paths may be any iterable and is consumed lazily, one image per free slot.
+        """
+        queue = iter(image_paths)
+        self._clear_batch()
+
+        while True:
+            if len(self.rows) < self.num_slots:
+                yield from self._admit(queue)
+            if not self.rows:
+                break
+
+            yield from self._step()
+            if not self.rows:
+                continue
+
+            try:
+                self._decode()
+            except Exception as e:
+                for row in self.rows:
+                    self._fail(row["path"], e)
+                    yield row["path"], None
+                self._clear_batch()
+
+    def utilization_report(self):
+        if not self.steps:
+            return "No generation steps were run"
+
+        lines = [f"Continuous batching: {self.steps} decode steps over {self.num_slots} slots"]
+        for slot, active in enumerate(self.slot_active_steps):
+            lines.append(f"  slot {slot}: {active / self.steps:.1%} utilized")
+        used = sum(self.slot_active_steps) / (self.steps * self.num_slots)
+        lines.append(f"  overall: {used:.1%} utilized")
+
+        # Static batching runs every batch until its longest caption ends
+        lengths = [length + 1 for length in self.caption_lengths]
+        static_steps = sum(
+            max(lengths[i:i + self.num_slots]) for i in range(0, len(lengths), self.num_slots)
+        )
+        if static_steps:
+            static_used = sum(lengths) / (static_steps * self.num_slots)
+            lines.append(f"  static batching estimate: {static_steps} steps, {static_used:.1%} utilized")
+        return "\n".join(lines)
@@ -0,0 +1,173 @@
+import argparse
+import difflib
+import time
+import warnings
+
+import torch
+from transformers import AutoProcessor, LlavaForConditionalGeneration
+
+from batch_caption import GENERATION_KWARGS, generate_captions, load_image, load_model
+from sources import iter_images
+
+CPU_DTYPES = ["auto", "float32", "bfloat16"]
+
+
+def bf16_supported():
+    """True when the CPU has native bfloat16 math (AVX512-BF16 or AMX)."""
+    checks = ("_is_avx512_bf16_supported", "_is_amx_tile_supported")
+    return any(getattr(torch.cpu, check, lambda: False)() for check in checks)
+
+
+def configure_threads(threads=None, interop_threads=None):
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # Only allowed before the first inter-op parallel work in the process
+            print("Inter-op threads were already fixed for this process; keeping the current setting")
+
+
+def submodule_names(model, suffixes):
+    """Outermost submodules whose names end with one of suffixes, across transformers versions."""
+    names = []
+    for name, _ in model.named_modules():
+        if name.endswith(suffixes) and not any(name.startswith(f"{other}.") for other in names):
+            names.append(name)
+    return names
+
+
+def quantize_language_model(model):
+    """Replace the language model's Linear layers with dynamically quantized int8 versions in place.
+
+    Weights are stored as int8 and activations are quantized on the fly per batch, so the
+    decoder, which does nearly all of the work during generation, runs on int8 matmul kernels.
+    The vision tower and projector are left alone.
+    """
+    qconfig = torch.ao.quantization.default_dynamic_qconfig
+    prefixes = tuple(f"{name}." for name in submodule_names(model, ("language_model",)))
+    spec = {
+        name: qconfig for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and (name.startswith(prefixes) or name == "lm_head")
+    }
+    with warnings.catch_warnings():
+        # Eager-mode quantization is marked deprecated in favour of torchao but still works
+        warnings.simplefilter("ignore")
+        torch.ao.quantization.quantize_dynamic(model, spec, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def load_cpu_fast_model(model_path, dtype="auto", threads=None, interop_threads=None, use_compile=False, quantize=True):
+    """Load the model for CPU inference: int8 language model, vision encoder in bf16 when the CPU supports it."""
+    configure_threads(threads, interop_threads)
+    if dtype == "auto":
+        dtype = "bfloat16" if bf16_supported() else "float32"
+    print(f"Loading JoyCaption model for CPU ({dtype} vision, {'int8' if quantize else 'float32'} language model, "
+          f"{torch.get_num_threads()} threads)")
+
+    processor = AutoProcessor.from_pretrained(model_path)
+    processor.tokenizer.padding_side = "left"
+    # Dynamic quantization takes float32 activations, so the text side stays float32
+    model = LlavaForConditionalGeneration.from_pretrained(model_path, torch_dtype=torch.float32, device_map="cpu")
+    model.eval()
+
+    if dtype == "bfloat16":
+        base = getattr(model, "model", model)
+        base.vision_tower.to(torch.bfloat16)
+        base.multi_modal_projector.to(torch.bfloat16)
+    if quantize:
+        quantize_language_model(model)
+    if use_compile:
+        for name in submodule_names(model, ("language_model",)):
+            module = model.get_submodule(name)
+            module.forward = torch.compile(module.forward, dynamic=True)
+
+    print("Model loaded successfully!")
+    return processor, model
+
+
+def similarity(a, b):
+    return difflib.SequenceMatcher(None, a.split(), b.split()).ratio()
+
+
+def quality_check(folder, model_path, sample=8, batch_size=1, max_new_tokens=64, **fast_options):
+    """Caption a sample with the reference and cpu-fast models using greedy decoding and compare."""
+    image_files = []
+    images = []
+    for image_file in iter_images(folder):
+        try:
+            images.append(load_image(image_file))
+            image_files.append(image_file)
+        except Exception as e:
+            print(f"Error loading {image_file}: {str(e)}")
+        if len(images) >= sample:
+            break
+    if not images:
+        print("No readable images found in the folder")
+        return None
+    generation_kwargs = dict(GENERATION_KWARGS, do_sample=False, temperature=None, top_p=None,
+                             max_new_tokens=max_new_tokens)
+
+    results = {}
+    for name, loader in (("reference", lambda: load_model(model_path)),
+                         ("cpu-fast", lambda: load_cpu_fast_model(model_path, **fast_options))):
+        processor, model = loader()
+        captions = []
+        start = time.perf_counter()
+        for i in range(0, len(images), batch_size):
+            captions.extend(generate_captions(processor, model, images[i:i + batch_size], "descriptive",
+                                              generation_kwargs=generation_kwargs))
+        results[name] = (captions, time.perf_counter() - start)
+        del model
+
+    reference, reference_seconds = results["reference"]
+    fast, fast_seconds = results["cpu-fast"]
+    scores = []
+    for image_file, expected, actual in zip(image_files, reference, fast):
+        scores.append(similarity(expected, actual))
+        print(f"{image_file.name}: {scores[-1]:.2f} word overlap")
+        if expected != actual:
+            print(f"  reference: {expected}")
+            print(f"  cpu-fast:  {actual}")
+
+    exact = sum(expected == actual for expected, actual in zip(reference, fast))
+    print(f"Mean word overlap {sum(scores) / len(scores):.3f}, {exact}/{len(scores)} identical captions")
+    print(f"Reference {reference_seconds:.1f}s, cpu-fast {fast_seconds:.1f}s "
+          f"({reference_seconds / fast_seconds:.2f}x)")
+    return sum(scores) / len(scores)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare cpu-fast captions against the reference model on a sample")
+    parser.add_argument("folder", help="Folder with sample images")
+    parser.add_argument("--model", default="llama-joycaption-beta-one-hf-llava",
+                       help="Path to JoyCaption model")
+    parser.add_argument("--sample", type=int, default=8,
+                       help="Number of images compared")
+    parser.add_argument("--batch-size", type=int, default=1,
+                       help="Number of images captioned per generate call")
+    parser.add_argument("--max-new-tokens", type=int, default=64,
+                       help="Caption length compared with greedy decoding")
+    parser.add_argument("--cpu-dtype", choices=CPU_DTYPES, default="auto",
+                       help="Vision encoder precision; auto picks bfloat16 when the CPU supports it")
+    parser.add_argument("--threads", type=int, default=None,
+                       help="Intra-op threads")
+    parser.add_argument("--interop-threads", type=int, default=None,
+                       help="Inter-op threads")
+    parser.add_argument("--compile", action="store_true",
+                       help="Compile the language model with torch.compile")
+    parser.add_argument("--min-overlap", type=float, default=None,
+                       help="Exit with an error when the mean word overlap is below this")
+
+    args = parser.parse_args()
+    score = quality_check(
+        args.folder, args.model, sample=args.sample, batch_size=max(1, args.batch_size),
+        max_new_tokens=args.max_new_tokens, dtype=args.cpu_dtype, threads=args.threads,
+        interop_threads=args.interop_threads, use_compile=args.compile,
+    )
+    if score is not None and args.min_overlap is not None and score < args.min_overlap:
+        raise SystemExit(f"Mean word overlap {score:.3f} is below {args.min_overlap}")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,87 @@
 import os
+import queue
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 import threading
+from collections import deque
 from pathlib import Path
-import torch
-from PIL import Image
-from transformers import AutoProcessor, LlavaForConditionalGeneration
 import time
+from batch_caption import BACKENDS, cancellable_kwargs, caption_images, get_target_size, load_model, write_caption
+from caption_client import CaptionClient, DEFAULT_URL
+from journal import DONE, FAILED, IN_FLIGHT, PENDING, RunJournal
+from pipeline import CaptionPipeline
+from sources import scan_folder
+
+UI_REFRESH_MS = 100
+LOG_LINES = 1000
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class ProgressTracker:
+    """Thread-safe run progress with throughput and ETA over a sliding time window.
+
+    Skipped images move the progress bar but not the throughput, so a run that starts with
+    thousands of already captioned images does not report an absurd rate and ETA.
+    """
+
+    def __init__(self, window=30.0):
+        self.window = window
+        self.lock = threading.Lock()
+        self.reset(0)
+
+    def reset(self, total, done=0):
+        with self.lock:
+            self.total = total
+            self.done = done
+            self.worked = 0
+            self.samples = deque([(time.monotonic(), 0)])
+            self.running = total > 0
+    
+    def finish(self):
+        with self.lock:
+            self.running = False
+
+    def advance(self, count=1, worked=True):
+        with self.lock:
+            self.done += count
+            if worked:
+                self.worked += count
+                now = time.monotonic()
+                self.samples.append((now, self.worked))
+                while len(self.samples) > 2 and now - self.samples[1][0] > self.window:
+                    self.samples.popleft()
+
+    def snapshot(self):
+        """Return (done, total, images per second or None, seconds left or None)."""
+        with self.lock:
+            done, total, running = self.done, self.total, self.running
+            start_time, start_count = self.samples[0]
+            last_time, last_count = self.samples[-1]
+        rate = None
+        if running and last_count > start_count and last_time > start_time:
+            rate = (last_count - start_count) / (time.monotonic() - start_time)
+        eta = (total - done) / rate if rate and total > done else None
+        return done, total, rate, eta
+
 
 class ImageCaptioner:
+    """Tk front end. Only the Tk thread touches widgets.
+
+    Worker threads report through three channels that the Tk loop drains every UI_REFRESH_MS:
+    log lines go to a bounded buffer, progress to a ProgressTracker and everything else (status
+    labels, buttons, dialogs) to an event queue of callbacks. However fast a run produces
+    updates, the widgets are refreshed at most once per tick and the log keeps only the last
+    LOG_LINES lines.
+    """
+
     def __init__(self):
         self.root = tk.Tk()
         self.root.title("JoyCaption Image Captioner")
@@ -23,8 +96,26 @@ class ImageCaptioner:
         self.status_var = tk.StringVar(value="Ready")
         self.caption_style = tk.StringVar(value="descriptive")
         self.overwrite_existing = tk.BooleanVar(value=False)
-        
-        self.model_path = "llama-joycaption-beta-one-hf-llava"
+        self.batch_size = tk.IntVar(value=1)
+        self.use_pipeline = tk.BooleanVar(value=False)
+        self.fast_load = tk.BooleanVar(value=False)
+        self.keep_journal = tk.BooleanVar(value=False)
+        self.journal = None
+        self.settings = None
+        
+        self.events = queue.Queue()
+        self.log_lock = threading.Lock()
+        self.log_buffer = deque(maxlen=LOG_LINES)
+        self.log_dropped = 0
+        self.progress = ProgressTracker()
+        self.status_text = "Ready"
+        self.shown_status = None
+        self.stop_event = threading.Event()
+        
+        self.model_path = tk.StringVar(value="llama-joycaption-beta-one-hf-llava")
+        self.backend = tk.StringVar(value="default")
+        self.client = None
+        self.daemon_url = tk.StringVar(value=DEFAULT_URL)
         
         self.supported_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.webp'}
         
@@ -72,6 +163,18 @@ class ImageCaptioner:
         ttk.Checkbutton(options_frame, text="Overwrite existing caption files", 
                        variable=self.overwrite_existing).grid(row=0, column=0, sticky=tk.W)
         
+        batch_frame = ttk.Frame(options_frame)
+        batch_frame.grid(row=1, column=0, sticky=tk.W, pady=(5, 0))
+        ttk.Label(batch_frame, text="Batch size:").pack(side=tk.LEFT)
+        ttk.Spinbox(batch_frame, from_=1, to=64, textvariable=self.batch_size, width=5).pack(side=tk.LEFT, padx=(10, 0))
+        
+        ttk.Checkbutton(options_frame, text="Load images in the background while captioning", 
+                       variable=self.use_pipeline).grid(row=2, column=0, sticky=tk.W, pady=(5, 0))
+        ttk.Checkbutton(options_frame, text="Fast loading for large images (decode at reduced resolution)", 
+                       variable=self.fast_load).grid(row=3, column=0, sticky=tk.W, pady=(5, 0))
+        ttk.Checkbutton(options_frame, text="Keep a run journal in the folder (resume interrupted runs, retry failed images)", 
+                       variable=self.keep_journal).grid(row=4, column=0, sticky=tk.W, pady=(5, 0))
+        
         # Model status
         model_frame = ttk.LabelFrame(main_frame, text="Model Status", padding="10")
         model_frame.grid(row=4, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=10)
@@ -83,6 +186,15 @@ class ImageCaptioner:
         
         ttk.Button(model_frame, text="Load Model", command=self.load_model_async).grid(row=0, column=2, padx=(10, 0))
         
+        ttk.Label(model_frame, text="Model path:").grid(row=1, column=0, sticky=tk.W, pady=(5, 0))
+        ttk.Entry(model_frame, textvariable=self.model_path, width=30).grid(row=1, column=1, sticky=(tk.W, tk.E), padx=(10, 0), pady=(5, 0))
+        ttk.Combobox(model_frame, textvariable=self.backend, values=list(BACKENDS), state="readonly", 
+                    width=10).grid(row=1, column=2, padx=(10, 0), pady=(5, 0))
+        
+        ttk.Label(model_frame, text="Daemon URL:").grid(row=2, column=0, sticky=tk.W, pady=(5, 0))
+        ttk.Entry(model_frame, textvariable=self.daemon_url, width=30).grid(row=2, column=1, sticky=(tk.W, tk.E), padx=(10, 0), pady=(5, 0))
+        ttk.Button(model_frame, text="Attach", command=self.attach_daemon_async).grid(row=2, column=2, padx=(10, 0), pady=(5, 0))
+        
         # Control buttons
         button_frame = ttk.Frame(main_frame)
         button_frame.grid(row=5, column=0, columnspan=3, pady=20)
@@ -117,12 +229,67 @@ class ImageCaptioner:
         self.log_text.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
         log_scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
         
-        self.stop_processing = False
-        
     def log_message(self, message):
-        self.log_text.insert(tk.END, f"{time.strftime('%H:%M:%S')} - {message}\n")
+        """Queue a log line; safe to call from any thread."""
+        line = f"{time.strftime('%H:%M:%S')} - {message}"
+        with self.log_lock:
+            if len(self.log_buffer) == self.log_buffer.maxlen:
+                self.log_dropped += 1
+            self.log_buffer.append(line)
+        
+    def call_in_ui(self, fn, *args, **kwargs):
+        """Run fn on the Tk thread at the next refresh; safe to call from any thread."""
+        self.events.put((fn, args, kwargs))
+        
+    def set_status(self, text):
+        self.status_text = text
+        
+    def process_events(self):
+        try:
+            while True:
+                try:
+                    fn, args, kwargs = self.events.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    fn(*args, **kwargs)
+                except Exception as e:
+                    self.log_message(f"UI update failed: {str(e)}")
+            self.flush_log()
+            self.refresh_progress()
+        finally:
+            self.root.after(UI_REFRESH_MS, self.process_events)
+            
+    def flush_log(self):
+        with self.log_lock:
+            lines = list(self.log_buffer)
+            dropped = self.log_dropped
+            self.log_buffer.clear()
+            self.log_dropped = 0
+        if not lines:
+            return
+        if dropped:
+            lines.insert(0, f"... {dropped} lines not shown")
+        self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+        # The widget keeps the newest LOG_LINES lines; the last line of a Text is always empty
+        excess = int(self.log_text.index("end-1c").split(".")[0]) - 1 - LOG_LINES
+        if excess > 0:
+            self.log_text.delete("1.0", f"{excess + 1}.0")
         self.log_text.see(tk.END)
-        self.root.update_idletasks()
+        
+    def refresh_progress(self):
+        done, total, rate, eta = self.progress.snapshot()
+        status = self.status_text
+        if total:
+            status = f"{status} - {done}/{total}"
+            if rate:
+                status += f", {rate:.2f} images/s"
+            if eta is not None:
+                status += f", {format_duration(eta)} left"
+        if status != self.shown_status:
+            self.shown_status = status
+            self.status_var.set(status)
+            self.progress_var.set(done / total * 100 if total else 0)
         
     def select_folder(self):
         folder = filedialog.askdirectory(title="Select folder containing images")
@@ -131,103 +298,78 @@ class ImageCaptioner:
             self.log_message(f"Selected folder: {folder}")
             
     def load_model_async(self):
-        threading.Thread(target=self.load_model, daemon=True).start()
+        self.model_status_label.config(text="Loading...", foreground="orange")
+        threading.Thread(target=self.load_model, args=(self.model_path.get(), self.backend.get()), daemon=True).start()
         
-    def load_model(self):
+    def load_model(self, model_path, backend="default"):
         try:
-            self.model_status_label.config(text="Loading...", foreground="orange")
-            self.log_message("Loading JoyCaption model...")
+            self.log_message(f"Loading JoyCaption model ({backend} backend)...")
             
-            if not os.path.exists(self.model_path):
-                raise FileNotFoundError(f"Model not found at: {self.model_path}")
+            if not os.path.exists(model_path):
+                raise FileNotFoundError(f"Model not found at: {model_path}")
             
-            self.processor = AutoProcessor.from_pretrained(self.model_path)
-            self.model = LlavaForConditionalGeneration.from_pretrained(
-                self.model_path, 
-                torch_dtype=torch.bfloat16, 
-                device_map="auto"
-            )
-            self.model.eval()
+            self.processor, self.model = load_model(model_path, backend=backend)
             
+            self.client = None
             self.model_loaded = True
-            self.model_status_label.config(text="Loaded", foreground="green")
-            self.start_button.config(state="normal")
+            self.call_in_ui(self.model_status_label.config, text="Loaded", foreground="green")
+            self.call_in_ui(self.start_button.config, state="normal")
             self.log_message("Model loaded successfully!")
             
         except Exception as e:
-            self.model_status_label.config(text="Error", foreground="red")
+            self.call_in_ui(self.model_status_label.config, text="Error", foreground="red")
             self.log_message(f"Error loading model: {str(e)}")
-            messagebox.showerror("Error", f"Failed to load model: {str(e)}")
+            self.call_in_ui(messagebox.showerror, "Error", f"Failed to load model: {str(e)}")
             
-    def get_caption_prompt(self, style):
-        if style == "descriptive":
-            return "Write a long detailed description for this image."
-        elif style == "straightforward":
-            return ("Write a straightforward caption for this image. Begin with the main subject and medium. "
-                   "Mention pivotal elements—people, objects, scenery—using confident, definite language. "
-                   "Focus on concrete details like color, shape, texture, and spatial relationships. "
-                   "Show how elements interact. Omit mood and speculative wording. If text is present, quote it exactly. "
-                   "Note any watermarks, signatures, or compression artifacts. Never mention what's absent, "
-                   "resolution, or unobservable details. Vary your sentence structure and keep the description concise, "
-                   "without starting with 'This image is…' or similar phrasing.")
-        elif style == "training":
-            return ("Write a short, simple caption describing this image. Use only factual, concrete details. "
-                   "Avoid atmospheric words, mood descriptions, or ambiguous language. Keep it brief and direct. "
-                   "Focus on what is clearly visible: subjects, objects, actions, basic colors, and clear visual elements. "
-                   "Do not use phrases like 'This image shows' or 'The photo depicts'. "
-                   "Avoid words that could have multiple meanings or interpretations.")
-        else:
-            return "Write a long detailed description for this image."
-            
-    def caption_image(self, image_path):
+    def attach_daemon_async(self):
+        self.model_status_label.config(text="Connecting...", foreground="orange")
+        threading.Thread(target=self.attach_daemon, args=(self.daemon_url.get(),), daemon=True).start()
+        
+    def attach_daemon(self, url):
         try:
-            image = Image.open(image_path).convert('RGB')
-            
-            prompt = self.get_caption_prompt(self.caption_style.get())
-            
-
-            convo = [
-                {
-                    "role": "system",
-                    "content": "You are a helpful image captioner.",
-                },
-                {
-                    "role": "user", 
-                    "content": prompt,
-                },
-            ]
+            client = CaptionClient(url)
+            health = client.health()
             
-            convo_string = self.processor.apply_chat_template(convo, tokenize=False, add_generation_prompt=True)
-            
-            inputs = self.processor(text=[convo_string], images=[image], return_tensors="pt")
-            
-            if torch.cuda.is_available():
-                inputs = {k: v.to('cuda') if hasattr(v, 'to') else v for k, v in inputs.items()}
-                if 'pixel_values' in inputs:
-                    inputs['pixel_values'] = inputs['pixel_values'].to(torch.bfloat16)
-            
-            with torch.no_grad():
-                generate_ids = self.model.generate(
-                    **inputs,
-                    max_new_tokens=512,
-                    do_sample=True,
-                    suppress_tokens=None,
-                    use_cache=True,
-                    temperature=0.6,
-                    top_k=None,
-                    top_p=0.9,
-                )[0]
-                
-                generate_ids = generate_ids[inputs['input_ids'].shape[1]:]
-                
-                caption = self.processor.tokenizer.decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-                caption = caption.strip()
-                
-            return caption
+            self.client = client
+            self.model_loaded = True
+            self.call_in_ui(self.model_status_label.config, text=f"Attached to daemon ({health['model']})", foreground="green")
+            self.call_in_ui(self.start_button.config, state="normal")
+            self.log_message(f"Attached to caption daemon at {url}")
             
         except Exception as e:
-            self.log_message(f"Error captioning {image_path}: {str(e)}")
-            return None
+            self.call_in_ui(self.model_status_label.config, text="Error", foreground="red")
+            self.log_message(f"Error attaching to daemon: {str(e)}")
+            self.call_in_ui(messagebox.showerror, "Error", f"Failed to attach to daemon: {str(e)}")
+            
+    def read_settings(self):
+        """Snapshot the options on the Tk thread, so the worker never reads Tk variables."""
+        try:
+            batch_size = max(1, self.batch_size.get())
+        except tk.TclError:
+            batch_size = 1
+        return {
+            "folder": Path(self.selected_folder.get()),
+            "style": self.caption_style.get(),
+            "overwrite": self.overwrite_existing.get(),
+            "batch_size": batch_size,
+            "pipeline": self.use_pipeline.get(),
+            "fast_load": self.fast_load.get(),
+            "journal": self.keep_journal.get(),
+        }
+        
+    def get_target_size(self):
+        return get_target_size(self.processor) if self.settings["fast_load"] else None
+        
+    def caption_images(self, image_paths):
+        if self.client is not None:
+            return self.client.caption_many(image_paths, self.settings["style"], log=self.log_message,
+                                            on_error=self.record_error)
+        return caption_images(self.processor, self.model, image_paths, self.settings["style"],
+                              log=self.log_message, target_size=self.get_target_size(),
+                              generation_kwargs=cancellable_kwargs(self.stop_event), on_error=self.record_error)
+        
+    def caption_image(self, image_path):
+        return self.caption_images([image_path])[0]
             
     def start_captioning(self):
         if not self.selected_folder.get():
@@ -238,80 +380,150 @@ class ImageCaptioner:
             messagebox.showerror("Error", "Please load the model first")
             return
             
-        self.stop_processing = False
+        self.settings = self.read_settings()
+        self.stop_event.clear()
         self.start_button.config(state="disabled")
         self.stop_button.config(state="normal")
         threading.Thread(target=self.process_images, daemon=True).start()
         
     def stop_captioning(self):
-        self.stop_processing = True
+        # Also ends the generate call in flight after its current token
+        self.stop_event.set()
+        self.stop_button.config(state="disabled")
         self.log_message("Stopping captioning process")
         
-    def process_images(self):
+    def record_error(self, image_file, error):
+        if self.journal is not None:
+            self.journal.mark_failed(image_file, error)
+            
+    def save_caption(self, image_file, caption):
         try:
-            folder_path = Path(self.selected_folder.get())
+            write_caption(image_file, caption)
+            if self.journal is not None:
+                self.journal.set_state(image_file, DONE)
+            self.log_message(f"Saved caption for {Path(image_file).name}")
+        except Exception as e:
+            self.log_message(f"Error saving caption for {Path(image_file).name}: {str(e)}")
+            self.record_error(image_file, f"saving the caption failed: {str(e)}")
             
-            image_files = []
-            for ext in self.supported_extensions:
-                image_files.extend(folder_path.glob(f"*{ext}"))
-                image_files.extend(folder_path.glob(f"*{ext.upper()}"))
-                
-            if not image_files:
-                self.log_message("No image files found in the selected folder")
-                return
+    def caption_in_batches(self, pending_files, batch_size):
+        for start in range(0, len(pending_files), batch_size):
+            if self.stop_event.is_set():
+                break
                 
-            self.log_message(f"Found {len(image_files)} image files")
-            total_files = len(image_files)
-            processed = 0
+            batch_files = pending_files[start:start + batch_size]
+            self.set_status(f"Processing {batch_files[0].name}" if len(batch_files) == 1
+                            else f"Processing {len(batch_files)} images")
+            for image_file in batch_files:
+                self.log_message(f"Captioning {image_file.name}")
             
-            self.progress_var.set(0)
-            self.root.update_idletasks()
+            captions = self.caption_images(batch_files)
+            if self.stop_event.is_set():
+                # Generation may have been cut short, so these captions are incomplete
+                break
             
-            for i, image_file in enumerate(image_files):
-                if self.stop_processing:
-                    break
-                    
-                caption_file = image_file.with_suffix('.txt')
-                if caption_file.exists() and not self.overwrite_existing.get():
-                    self.log_message(f"Skipping {image_file.name} caption already exists")
-                    processed += 1
-                    continue
-                    
-                self.status_var.set(f"Processing {image_file.name}")
-                self.log_message(f"Captioning {image_file.name}")
-                
-                caption = self.caption_image(image_file)
-                
+            for image_file, caption in zip(batch_files, captions):
                 if caption:
-                    try:
-                        with open(caption_file, 'w', encoding='utf-8') as f:
-                            f.write(caption)
-                        self.log_message(f"Saved caption for {image_file.name}")
-                    except Exception as e:
-                        self.log_message(f"Error saving caption for {image_file.name}: {str(e)}")
+                    self.save_caption(image_file, caption)
+            
+            self.progress.advance(len(batch_files))
+        
+    def caption_with_pipeline(self, pending_files, batch_size):
+        pipeline = CaptionPipeline(
+            self.processor, self.model, self.settings["style"],
+            batch_size=batch_size,
+            write_fn=self.save_caption,
+            log=self.log_message,
+            target_size=self.get_target_size(),
+            generation_kwargs=cancellable_kwargs(self.stop_event),
+            on_error=self.record_error,
+        )
+        
+        def on_result(image_file, caption):
+            self.set_status(f"Processed {Path(image_file).name}")
+            self.progress.advance()
+            
+        pipeline.run(pending_files, should_stop=self.stop_event.is_set, on_result=on_result)
+        self.log_message(pipeline.report())
+        
+    def open_journal(self, folder_path):
+        """Return (journal, images left by an earlier run, or None when starting fresh)."""
+        journal = RunJournal(folder_path / "caption_journal.sqlite")
+        settings = {"folder": str(folder_path.resolve()), "style": self.settings["style"]}
+        if journal.settings == settings and not self.settings["overwrite"]:
+            leftover = list(journal.items([PENDING, IN_FLIGHT, FAILED]))
+            if leftover:
+                return journal, leftover
+        journal.start(settings)
+        return journal, None
+        
+    def process_images(self):
+        try:
+            folder_path = self.settings["folder"]
+            batch_size = self.settings["batch_size"]
+            
+            pending_files = None
+            if self.settings["journal"]:
+                self.journal, pending_files = self.open_journal(folder_path)
                 
-                processed += 1
-                progress = (processed / total_files) * 100
-                self.progress_var.set(progress)
-                self.root.update_idletasks()
+            if pending_files is not None:
+                self.log_message(f"Resuming {len(pending_files)} images left by the previous run")
+                self.progress.reset(len(pending_files))
+            else:
+                self.set_status("Scanning folder")
+                image_files = list(scan_folder(folder_path, extensions=self.supported_extensions))
+                    
+                if not image_files:
+                    self.log_message("No image files found in the selected folder")
+                    return
+                    
+                self.log_message(f"Found {len(image_files)} image files")
+                self.progress.reset(len(image_files))
                 
-            if self.stop_processing:
-                self.status_var.set("Captioning stopped")
+                pending_files = []
+                for image_file in image_files:
+                    caption_file = image_file.with_suffix('.txt')
+                    if caption_file.exists() and not self.settings["overwrite"]:
+                        self.log_message(f"Skipping {image_file.name} caption already exists")
+                        if self.journal is not None:
+                            self.journal.add(image_file, DONE)
+                        self.progress.advance(worked=False)
+                        continue
+                    if self.journal is not None:
+                        self.journal.add(image_file)
+                    pending_files.append(image_file)
+            
+            if self.settings["pipeline"] and self.client is None:
+                self.caption_with_pipeline(pending_files, batch_size)
+            else:
+                self.caption_in_batches(pending_files, batch_size)
+            
+            processed = self.progress.snapshot()[0]
+            if self.stop_event.is_set():
+                self.set_status("Captioning stopped")
                 self.log_message("Captioning process stopped by user")
             else:
-                self.status_var.set("Captioning completed")
+                self.set_status("Captioning completed")
                 self.log_message(f"Captioning completed! Processed {processed} images")
+                if self.journal is not None:
+                    self.journal.finish()
+                    self.log_message(self.journal.report())
                 
         except Exception as e:
             self.log_message(f"Error during processing: {str(e)}")
-            messagebox.showerror("Error", f"Error during processing: {str(e)}")
+            self.call_in_ui(messagebox.showerror, "Error", f"Error during processing: {str(e)}")
             
         finally:
-            self.start_button.config(state="normal")
-            self.stop_button.config(state="disabled")
+            self.progress.finish()
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            self.call_in_ui(self.start_button.config, state="normal")
+            self.call_in_ui(self.stop_button.config, state="disabled")
             
     def run(self):
         self.log_message("JoyCaption Image Captioner started")
+        self.process_events()
         self.root.mainloop()
 
 if __name__ == "__main__":
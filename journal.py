@@ -0,0 +1,184 @@
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from sources import ShardMember
+
+PENDING = "pending"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+
+
+class RunJournal:
+    """Crash-safe record of a captioning run in a SQLite file.
+
+    Every image the run sees is stored with its state: pending, in_flight, done or failed (with
+    the error message). Updates are committed every commit_every changes or commit_interval
+    seconds, so the cost is one fsync per group of images, not one per image. After a crash the
+    journal tells a resumed run exactly which images are left, without scanning the dataset again.
+    before_commit, typically the output sink's flush, runs before every commit so an image is never
+    recorded as done while its caption is still sitting in a buffer.
+    """
+
+    def __init__(self, path, commit_every=256, commit_interval=2.0, before_commit=None):
+        self.path = Path(path)
+        self.before_commit = before_commit
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        self.changes = 0
+        self.last_commit = time.monotonic()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "key TEXT PRIMARY KEY, shard TEXT, member TEXT, offset INTEGER, size INTEGER, "
+            "state TEXT NOT NULL, error TEXT, attempts INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS items_state ON items (state)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.commit()
+
+    def _changed(self, count=1):
+        self.changes += count
+        if self.changes >= self.commit_every or time.monotonic() - self.last_commit >= self.commit_interval:
+            self._commit()
+
+    def _commit(self):
+        if self.before_commit is not None:
+            self.before_commit()
+        self.conn.commit()
+        self.changes = 0
+        self.last_commit = time.monotonic()
+
+    def _get_meta(self, name):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _set_meta(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, json.dumps(value)))
+
+    def start(self, settings):
+        """Forget any previous run and record the settings of a new one."""
+        with self.lock:
+            self.conn.execute("DELETE FROM items")
+            self.conn.execute("DELETE FROM meta")
+            self._set_meta("settings", settings)
+            self._set_meta("enumerated", False)
+            self._commit()
+
+    @property
+    def settings(self):
+        with self.lock:
+            return self._get_meta("settings")
+
+    @property
+    def enumerated(self):
+        """True once the run has seen every image in its input."""
+        with self.lock:
+            return bool(self._get_meta("enumerated"))
+
+    def mark_enumerated(self):
+        with self.lock:
+            self._set_meta("enumerated", True)
+            self._commit()
+
+    @staticmethod
+    def key(image_path):
+        return str(image_path)
+
+    def knows(self, image_path):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM items WHERE key = ?", (self.key(image_path),)).fetchone() is not None
+
+    def add(self, image_path, state=PENDING):
+        if isinstance(image_path, ShardMember):
+            shard, member, offset, size = str(image_path.shard), image_path.member, image_path.offset, image_path.size
+        else:
+            shard = member = offset = size = None
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO items (key, shard, member, offset, size, state, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.key(image_path), shard, member, offset, size, state, time.time()),
+            )
+            self._changed()
+
+    def set_state(self, image_path, state, error=None):
+        with self.lock:
+            attempts = ", attempts = attempts + 1" if state == IN_FLIGHT else ""
+            self.conn.execute(
+                f"UPDATE items SET state = ?, error = ?, updated = ?{attempts} WHERE key = ?",
+                (state, error, time.time(), self.key(image_path)),
+            )
+            self._changed()
+
+    def items(self, states, chunk_size=1000):
+        """Yield the images in the given states in the order they were first seen.
+
+        Rows are read in chunks so the journal can be updated while the run consumes them.
+        """
+        placeholders = ", ".join("?" for _ in states)
+        last = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    f"SELECT rowid, key, shard, member, offset, size FROM items "
+                    f"WHERE rowid > ? AND state IN ({placeholders}) ORDER BY rowid LIMIT ?",
+                    (last, *states, chunk_size),
+                ).fetchall()
+            if not rows:
+                return
+            for rowid, key, shard, member, offset, size in rows:
+                last = rowid
+                yield ShardMember(shard, member, offset=offset, size=size) if shard is not None else Path(key)
+
+    def dispatch(self, image_files):
+        """Mark images in flight as the captioning loop takes them."""
+        for image_file in image_files:
+            self.set_state(image_file, IN_FLIGHT)
+            yield image_file
+
+    def mark_done(self, image_path):
+        self.set_state(image_path, DONE)
+
+    def mark_failed(self, image_path, error):
+        self.set_state(image_path, FAILED, error)
+
+    def writer(self, write_fn):
+        """Wrap write_fn so every saved caption marks its image done."""
+        def write(image_file, caption, *args, **info):
+            write_fn(image_file, caption, *args, **info)
+            self.set_state(image_file, DONE)
+        return write
+
+    def finish(self):
+        """Mark every image this run neither captioned nor failed explicitly as failed and commit."""
+        with self.lock:
+            keys = [row[0] for row in self.conn.execute(
+                "SELECT key FROM items WHERE state IN (?, ?)", (PENDING, IN_FLIGHT)
+            )]
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE items SET state = ?, error = ?, updated = ? WHERE key = ?",
+                [(FAILED, "no caption was produced", now, key) for key in keys],
+            )
+            self._commit()
+
+    def counts(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+
+    def report(self):
+        counts = self.counts()
+        return "Journal: " + ", ".join(f"{counts.get(state, 0)} {state}" for state in (DONE, FAILED, PENDING, IN_FLIGHT))
+
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.conn.close()
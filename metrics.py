@@ -0,0 +1,265 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+STAGES = ["hash", "image_decode", "preprocess", "h2d", "vision_encode", "prefill", "generate", "detokenize", "write", "flush"]
+PROMETHEUS_PREFIX = "joycaption"
+
+
+class Metrics:
+    """Stage timers, counters, value summaries and gauges for a captioning run.
+
+    Everything is a no-op until enable() is called, so the instrumented code paths cost one
+    attribute check when metrics are off. Updates take a lock, because the pipeline, the caption
+    server and the GUI record from several threads. With tracing on, every timed stage is also
+    kept as a Chrome trace event (one lane per thread) and every gauge update as a counter event.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.perf_counter()
+            self.timings = {}
+            self.values = {}
+            self.counters = {}
+            self.gauges = {}
+            self.trace_events = None
+            self.thread_names = {}
+            self.max_trace_events = 0
+            self.dropped_events = 0
+
+    def enable(self, trace=False, max_trace_events=1_000_000):
+        self.reset()
+        with self.lock:
+            if trace:
+                self.trace_events = []
+                self.max_trace_events = max_trace_events
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def _trace(self, event):
+        if len(self.trace_events) < self.max_trace_events:
+            self.trace_events.append(event)
+        else:
+            self.dropped_events += 1
+
+    @staticmethod
+    def _summarize(summaries, name, value):
+        summary = summaries.get(name)
+        if summary is None:
+            summaries[name] = [1, value, value, value]
+        else:
+            summary[0] += 1
+            summary[1] += value
+            summary[2] = min(summary[2], value)
+            summary[3] = max(summary[3], value)
+
+    def record(self, stage, start, end, **args):
+        """Record a stage that ran from start to end (time.perf_counter values)."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self._summarize(self.timings, stage, end - start)
+            if self.trace_events is not None:
+                thread = threading.current_thread()
+                self.thread_names[thread.ident] = thread.name
+                event = {"name": stage, "ph": "X", "ts": (start - self.start) * 1e6, "dur": (end - start) * 1e6,
+                         "pid": os.getpid(), "tid": thread.ident}
+                if args:
+                    event["args"] = args
+                self._trace(event)
+
+    @contextmanager
+    def stage(self, stage, **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, start, time.perf_counter(), **args)
+
+    def timed(self, stage, fn):
+        """Wrap fn so every call is recorded as stage."""
+        def wrapper(*args, **kwargs):
+            with self.stage(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        """Add value to the count/sum/min/max summary of name, e.g. tokens per image."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self._summarize(self.values, name, value)
+
+    def gauge(self, name, value, **labels):
+        """Set a gauge such as a queue depth; the maximum seen is kept as well."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            gauge = self.gauges.get(key)
+            if gauge is None:
+                self.gauges[key] = [value, value]
+            else:
+                gauge[0] = value
+                gauge[1] = max(gauge[1], value)
+            if self.trace_events is not None:
+                series = ",".join(f"{k}={v}" for k, v in key[1]) or name
+                self._trace({"name": name, "ph": "C", "ts": (time.perf_counter() - self.start) * 1e6,
+                             "pid": os.getpid(), "args": {series: value}})
+
+    def summary(self):
+        """Human readable table of stage times, counters, summaries and gauges."""
+        with self.lock:
+            timings = dict(self.timings)
+            values = dict(self.values)
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            elapsed = time.perf_counter() - self.start
+
+        lines = [f"Run metrics ({elapsed:.1f}s wall time, stage times summed over threads):"]
+        if timings:
+            lines.append(f"  {'stage':<14}{'calls':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}{'share':>8}")
+            total = sum(summary[1] for summary in timings.values())
+            ordered = [stage for stage in STAGES if stage in timings] + sorted(set(timings) - set(STAGES))
+            for stage in ordered:
+                calls, seconds, _, longest = timings[stage]
+                lines.append(f"  {stage:<14}{calls:>8}{seconds:>10.2f}{seconds / calls * 1000:>10.1f}"
+                             f"{longest * 1000:>10.1f}{seconds / total if total else 0:>8.1%}")
+        for name, value in sorted(counters.items()):
+            lines.append(f"  {name}: {value}")
+        for name, (count, total, smallest, largest) in sorted(values.items()):
+            lines.append(f"  {name}: mean {total / count:.1f}, min {smallest:g}, max {largest:g} over {count}")
+        for (name, labels), (last, largest) in sorted(gauges.items()):
+            label = ", ".join(f"{k}={v}" for k, v in labels)
+            lines.append(f"  {name}{f' [{label}]' if label else ''}: last {last:g}, max {largest:g}")
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format."""
+        with self.lock:
+            timings = dict(self.timings)
+            values = dict(self.values)
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+
+        lines = []
+        if timings:
+            lines.append(f"# HELP {PROMETHEUS_PREFIX}_stage_seconds Time spent in each captioning stage")
+            lines.append(f"# TYPE {PROMETHEUS_PREFIX}_stage_seconds summary")
+            for stage, (calls, seconds, _, _) in sorted(timings.items()):
+                lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {seconds:.6f}')
+                lines.append(f'{PROMETHEUS_PREFIX}_stage_seconds_count{{stage="{stage}"}} {calls}')
+        for name, value in sorted(counters.items()):
+            metric = f"{PROMETHEUS_PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        for name, (count, total, _, _) in sorted(values.items()):
+            metric = f"{PROMETHEUS_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} summary")
+            lines.append(f"{metric}_sum {total}")
+            lines.append(f"{metric}_count {count}")
+        families = {}
+        for (name, labels), gauge in sorted(gauges.items()):
+            families.setdefault(name, []).append((labels, gauge))
+        for name, series in families.items():
+            for suffix, index in (("", 0), ("_max", 1)):
+                metric = f"{PROMETHEUS_PREFIX}_{name}{suffix}"
+                lines.append(f"# TYPE {metric} gauge")
+                for labels, gauge in series:
+                    label = ",".join(f'{k}="{v}"' for k, v in labels)
+                    lines.append(f"{metric}{{{label}}} {gauge[index]}" if label else f"{metric} {gauge[index]}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write prometheus() atomically, so a textfile collector never reads a partial file."""
+        path = Path(path)
+        temp_path = path.with_name(f".{path.name}.tmp")
+        temp_path.write_text(self.prometheus(), encoding="utf-8")
+        os.replace(temp_path, path)
+
+    def write_trace(self, path):
+        """Write the recorded events as Chrome trace JSON (chrome://tracing or ui.perfetto.dev)."""
+        with self.lock:
+            events = list(self.trace_events or [])
+            thread_names = dict(self.thread_names)
+            dropped = self.dropped_events
+        for tid, name in thread_names.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}})
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms",
+                       "otherData": {"dropped_events": dropped}}, f)
+
+
+class GenerationTimer:
+    """Streamer for model.generate() that splits a generate call into prefill and generate stages.
+
+    generate() hands the prompt to the streamer before running the model and then every new
+    token as it is sampled, so the first put after the prompt marks the end of the prefill.
+    """
+
+    def __init__(self, metrics, batch_size):
+        self.metrics = metrics
+        self.batch_size = batch_size
+        self.start = time.perf_counter()
+        self.prompt_seen = False
+        self.first_token = None
+
+    def put(self, value):
+        if not self.prompt_seen:
+            self.prompt_seen = True
+        elif self.first_token is None:
+            self.first_token = time.perf_counter()
+            self.metrics.record("prefill", self.start, self.first_token, batch=self.batch_size)
+
+    def end(self):
+        end = time.perf_counter()
+        if self.first_token is None:
+            self.metrics.record("prefill", self.start, end, batch=self.batch_size)
+        else:
+            self.metrics.record("generate", self.first_token, end, batch=self.batch_size)
+
+
+class PrometheusExporter:
+    """Rewrite a Prometheus text file every interval seconds until stopped, then once more."""
+
+    def __init__(self, metrics, path, interval=15.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.metrics.write_prometheus(self.path)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.metrics.write_prometheus(self.path)
+
+
+metrics = Metrics()
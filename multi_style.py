@@ -0,0 +1,277 @@
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from batch_caption import GENERATION_KWARGS, get_prompt_cache, load_image, move_to_device, record_tokens
+from caption_cache import hash_file
+from metrics import GenerationTimer, metrics
+
+
+def vision_modules(model):
+    base = getattr(model, "model", None)
+    if base is not None and hasattr(base, "vision_tower"):
+        return base.vision_tower, base.multi_modal_projector
+    return model.vision_tower, model.multi_modal_projector
+
+
+def image_token_id(model):
+    config = model.config
+    token_id = getattr(config, "image_token_id", None)
+    return token_id if token_id is not None else config.image_token_index
+
+
+def encode_images(model, pixel_values):
+    """Run the vision tower and projector once and return features of shape [batch, tokens, hidden]."""
+    config = model.config
+    vision_tower, projector = vision_modules(model)
+    parameter = next(projector.parameters())
+    pixel_values = pixel_values.to(device=parameter.device, dtype=parameter.dtype)
+
+    with torch.no_grad():
+        outputs = vision_tower(pixel_values, output_hidden_states=True)
+        layers = config.vision_feature_layer
+        if isinstance(layers, int):
+            layers = [layers]
+        hidden_states = [outputs.hidden_states[layer] for layer in layers]
+        if config.vision_feature_select_strategy == "default":
+            # Drop the CLS token
+            hidden_states = [hidden[:, 1:] for hidden in hidden_states]
+        return projector(torch.cat(hidden_states, dim=-1))
+
+
+def embed_prompt(model, input_ids, features):
+    """Text embeddings with the image token positions replaced by precomputed image features."""
+    embeddings = model.get_input_embeddings()(input_ids)
+    mask = (input_ids == image_token_id(model)).unsqueeze(-1).expand_as(embeddings)
+    return embeddings.masked_scatter(mask, features.to(embeddings.device, embeddings.dtype))
+
+
+def generate_from_features(processor, model, input_ids, features):
+    inputs_embeds = embed_prompt(model, input_ids, features)
+    generation_kwargs = GENERATION_KWARGS
+    if metrics.enabled:
+        generation_kwargs = dict(generation_kwargs, streamer=GenerationTimer(metrics, input_ids.shape[0]))
+    with torch.no_grad():
+        # With only inputs_embeds, generate returns just the new tokens
+        generate_ids = model.generate(
+            inputs_embeds=inputs_embeds,
+            attention_mask=torch.ones_like(input_ids),
+            **generation_kwargs,
+        )
+    with metrics.stage("detokenize"):
+        captions = processor.tokenizer.batch_decode(generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+    if metrics.enabled:
+        record_tokens((generate_ids != processor.tokenizer.pad_token_id).sum(dim=1).tolist())
+    return [caption.strip() for caption in captions]
+
+
+class FeatureStore:
+    """On-disk store of projected image features, memory-mapped for reading.
+
+    Features are appended as fixed-size records to features.bin and located through a SQLite
+    index keyed by image content hash. meta.json records the model, processor, backend and vision
+    dtype the features came from, so a store is never reused for a different vision encoder.
+    """
+
+    def __init__(self, path, context):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.context = context
+        self.data_path = self.path / "features.bin"
+        self.meta_path = self.path / "meta.json"
+        self.lock = threading.Lock()
+        self.meta = None
+        self.rows = 0
+        self.mmap = None
+
+        if self.meta_path.exists():
+            self.meta = json.loads(self.meta_path.read_text())
+            if self.meta["context"] != context:
+                raise ValueError(f"Feature store {self.path} was built for a different model, processor, "
+                                 "backend or dtype")
+            self.rows = self.data_path.stat().st_size // self.record_size if self.data_path.exists() else 0
+            if self.data_path.exists():
+                # Drop a record torn by a kill during an append, so new records land on their row
+                with open(self.data_path, 'r+b') as f:
+                    f.truncate(self.rows * self.record_size)
+
+        self.conn = sqlite3.connect(str(self.path / "index.sqlite"), check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS features (key TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        self.conn.execute("DELETE FROM features WHERE row >= ?", (self.rows,))
+        self.conn.commit()
+
+    @property
+    def record_size(self):
+        return int(np.prod(self.meta["shape"])) * np.dtype(self.meta["storage"]).itemsize
+
+    def _init_meta(self, features):
+        # bfloat16 has no numpy dtype, so it is stored bit-for-bit as int16
+        storage = "int16" if features.dtype == torch.bfloat16 else str(features.dtype).replace("torch.", "")
+        self.meta = {
+            "context": self.context,
+            "shape": list(features.shape[1:]),
+            "dtype": str(features.dtype).replace("torch.", ""),
+            "storage": storage,
+        }
+        self.meta_path.write_text(json.dumps(self.meta))
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT row FROM features WHERE key = ?", (key,)).fetchone()
+            if row is None or self.meta is None:
+                return None
+            if self.mmap is None or len(self.mmap) < self.rows:
+                self.mmap = np.memmap(self.data_path, dtype=self.meta["storage"], mode='r',
+                                      shape=(self.rows, *self.meta["shape"]))
+            features = torch.from_numpy(np.array(self.mmap[row[0]]))
+        if self.meta["dtype"] == "bfloat16":
+            features = features.view(torch.bfloat16)
+        return features
+
+    def put(self, key, features):
+        """Store features for one image, shape [tokens, hidden]."""
+        features = features.detach().cpu().unsqueeze(0)
+        with self.lock:
+            if self.meta is None:
+                self._init_meta(features)
+            if list(features.shape[1:]) != self.meta["shape"]:
+                raise ValueError(f"Features of shape {list(features.shape[1:])} do not fit feature store "
+                                 f"{self.path} (shape {self.meta['shape']})")
+            # Records are read back as meta["dtype"], so anything else would be stored as garbage
+            features = features.to(getattr(torch, self.meta["dtype"]))
+            if self.conn.execute("SELECT 1 FROM features WHERE key = ?", (key,)).fetchone():
+                return
+            if features.dtype == torch.bfloat16:
+                features = features.view(torch.int16)
+            with open(self.data_path, 'r+b' if self.data_path.exists() else 'wb') as f:
+                f.seek(self.rows * self.record_size)
+                f.write(features.numpy().astype(self.meta["storage"], copy=False).tobytes())
+            self.conn.execute("INSERT INTO features (key, row) VALUES (?, ?)", (key, self.rows))
+            self.conn.commit()
+            self.rows += 1
+
+    def close(self):
+        with self.lock:
+            self.mmap = None
+            self.conn.close()
+
+
+class MultiStyleCaptioner:
+    """Caption images in several styles while running the vision encoder once per image."""
+
+    def __init__(self, processor, model, styles, target_size=None, feature_store=None, log=print, on_error=None):
+        self.processor = processor
+        self.model = model
+        self.styles = list(styles)
+        self.target_size = target_size
+        self.feature_store = feature_store
+        self.log = log
+        self.on_error = on_error
+        self.prompt_cache = get_prompt_cache(processor)
+        # (style, number of image tokens) -> prompt token ids, filled from real processor outputs
+        self.prompt_ids = {}
+        self.encoded = 0
+        self.reused = 0
+
+    def _report(self, image_paths, error):
+        if self.on_error:
+            for image_path in image_paths:
+                self.on_error(image_path, error)
+
+    def _has_prompts(self, num_image_tokens):
+        return all((style, num_image_tokens) in self.prompt_ids for style in self.styles)
+
+    def _prime_prompts(self, images):
+        inputs = None
+        for style in self.styles:
+            style_inputs = self.prompt_cache.preprocess(images if inputs is None else images[:1], style)
+            input_ids = style_inputs["input_ids"][0]
+            num_image_tokens = int((input_ids == image_token_id(self.model)).sum())
+            self.prompt_ids[(style, num_image_tokens)] = input_ids
+            if inputs is None:
+                inputs = style_inputs
+        return inputs
+
+    def _features(self, image_paths):
+        """Return {image_path: features}; failed images are logged and left out."""
+        features = {}
+        to_encode = []
+        keys = {}
+        for image_path in image_paths:
+            if self.feature_store is not None:
+                try:
+                    keys[image_path] = hash_file(image_path)
+                    cached = self.feature_store.get(keys[image_path])
+                except Exception as e:
+                    self.log(f"Error reading features for {image_path}: {str(e)}")
+                    cached = None
+                if cached is not None and not self._has_prompts(cached.shape[0]):
+                    # Prompt ids come from preprocessing a real image once; the vision encoder is still skipped
+                    try:
+                        self._prime_prompts([load_image(image_path, self.target_size)])
+                    except Exception as e:
+                        self.log(f"Error captioning {image_path}: {str(e)}")
+                if cached is not None and self._has_prompts(cached.shape[0]):
+                    features[image_path] = cached
+                    self.reused += 1
+                    metrics.count("feature_store_hits")
+                    continue
+            to_encode.append(image_path)
+
+        images = []
+        loaded = []
+        for image_path in to_encode:
+            try:
+                images.append(load_image(image_path, self.target_size))
+                loaded.append(image_path)
+            except Exception as e:
+                self.log(f"Error captioning {image_path}: {str(e)}")
+                self._report([image_path], str(e))
+        if not images:
+            return features
+
+        inputs = self._prime_prompts(images)
+        pixel_values = move_to_device(inputs)["pixel_values"]
+        with metrics.stage("vision_encode", batch=len(loaded)):
+            encoded = encode_images(self.model, pixel_values)
+        self.encoded += len(loaded)
+        metrics.count("images_encoded", len(loaded))
+        for image_path, image_features in zip(loaded, encoded):
+            features[image_path] = image_features
+            if self.feature_store is not None and image_path in keys:
+                self.feature_store.put(keys[image_path], image_features)
+        return features
+
+    def caption_batch(self, image_paths):
+        """Return {image_path: {style: caption or None}}."""
+        results = {image_path: {style: None for style in self.styles} for image_path in image_paths}
+        try:
+            features = self._features(image_paths)
+        except Exception as e:
+            self.log(f"Error encoding batch: {str(e)}")
+            self._report(image_paths, str(e))
+            return results
+        if not features:
+            return results
+
+        paths = list(features)
+        stacked = torch.stack([features[image_path].to(self.model.device) for image_path in paths])
+        for style in self.styles:
+            input_ids = self.prompt_ids[(style, stacked.shape[1])]
+            input_ids = move_to_device({"input_ids": input_ids.unsqueeze(0).repeat(len(paths), 1)})["input_ids"]
+            try:
+                captions = generate_from_features(self.processor, self.model, input_ids, stacked)
+            except Exception as e:
+                self.log(f"Error captioning batch in {style} style: {str(e)}")
+                self._report(paths, f"{style} style: {str(e)}")
+                continue
+            for image_path, caption in zip(paths, captions):
+                results[image_path][style] = caption
+        return results
+
+    def report(self):
+        return f"Vision features: {self.encoded} images encoded, {self.reused} reused from the feature store"
@@ -0,0 +1,146 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from metrics import metrics
+from sources import open_image
+
+HASH_BITS = 64
+
+
+def dhash(image_path, hash_size=8):
+    """64-bit difference hash: compares neighbouring pixels of a tiny grayscale thumbnail."""
+    image = open_image(image_path)
+    if image.format == "JPEG":
+        # Decoding at 1/8 scale is plenty for a 9x8 thumbnail
+        image.draft('L', (hash_size * 4, hash_size * 4))
+    pixels = list(image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR).getdata())
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class MultiIndexHash:
+    """Hamming-distance index using multi-index hashing.
+
+    The hash is split into m chunks with one lookup table each. If two hashes are within
+    distance r, at least one chunk differs by at most r // m bits (pigeonhole), so a query only
+    probes the buckets within that radius in each table instead of comparing against every
+    stored hash.
+    """
+
+    def __init__(self, threshold, bits=HASH_BITS, max_chunks=4):
+        self.threshold = threshold
+        # Small thresholds get exact chunk matches; larger ones keep ~16-bit chunks and probe nearby buckets
+        num_chunks = max(1, min(threshold + 1, max_chunks, bits))
+        self.radius = threshold // num_chunks
+        widths = [bits // num_chunks + (1 if i < bits % num_chunks else 0) for i in range(num_chunks)]
+        self.chunks = []
+        shift = bits
+        for width in widths:
+            shift -= width
+            self.chunks.append((shift, (1 << width) - 1, flip_masks(width, self.radius)))
+        self.tables = [{} for _ in self.chunks]
+        self.entries = []
+
+    def add(self, value, item):
+        index = len(self.entries)
+        self.entries.append((value, item))
+        for table, (shift, mask, _) in zip(self.tables, self.chunks):
+            table.setdefault((value >> shift) & mask, []).append(index)
+
+    def query(self, value):
+        """Return the closest stored (item, distance) within the threshold, or None."""
+        best = None
+        seen = set()
+        for table, (shift, mask, flips) in zip(self.tables, self.chunks):
+            chunk = (value >> shift) & mask
+            for flip in flips:
+                for index in table.get(chunk ^ flip, ()):
+                    if index in seen:
+                        continue
+                    seen.add(index)
+                    stored, item = self.entries[index]
+                    distance = hamming(value, stored)
+                    if distance <= self.threshold and (best is None or distance < best[1]):
+                        best = (item, distance)
+                        if distance == 0:
+                            return best
+        return best
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def flip_masks(width, radius):
+    """All masks of width bits with at most radius bits set, starting with 0."""
+    masks = [0]
+    frontier = [0]
+    for _ in range(radius):
+        next_frontier = []
+        for mask in frontier:
+            for bit in range(mask.bit_length(), width):
+                next_frontier.append(mask | (1 << bit))
+        masks.extend(next_frontier)
+        frontier = next_frontier
+    return masks
+
+
+def compute_hashes(image_files, workers=8, log=print):
+    def safe_hash(image_file):
+        try:
+            with metrics.stage("hash"):
+                return dhash(image_file)
+        except Exception as e:
+            log(f"Error hashing {image_file}: {str(e)}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(safe_hash, image_files, chunksize=64))
+
+
+def cluster_near_duplicates(image_files, threshold=4, workers=8, log=print):
+    """Group images whose perceptual hashes are within threshold bits of a cluster representative.
+
+    Clusters are formed greedily in input order: an image joins the closest existing
+    representative within the threshold or becomes a new representative. Every member is
+    therefore within the threshold of the image whose caption it receives.
+    Returns (representatives, members) where members maps a representative to its other files.
+    """
+    index = MultiIndexHash(threshold)
+    representatives = []
+    members = {}
+    for image_file, value in zip(image_files, compute_hashes(image_files, workers, log)):
+        if value is not None:
+            match = index.query(value)
+            if match is not None:
+                members[match[0]].append(image_file)
+                continue
+            index.add(value, image_file)
+        representatives.append(image_file)
+        members[image_file] = []
+    return representatives, members
+
+
+def propagating_writer(members, write_fn, member_write_fn=None):
+    """Wrap write_fn so a representative's caption is also written for its cluster members.
+
+    Members are written with member_write_fn when given, so a caption cache only stores the
+    caption under the representative's content.
+    """
+    member_write_fn = member_write_fn or write_fn
+
+    def write(image_file, caption, **info):
+        write_fn(image_file, caption, **info)
+        for member in members.get(image_file, ()):
+            member_write_fn(member, caption, **info)
+            metrics.count("near_duplicate_captions")
+    return write
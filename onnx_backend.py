@@ -0,0 +1,331 @@
+import argparse
+import json
+import tempfile
+import warnings
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import AutoProcessor, LlavaForConditionalGeneration
+
+from batch_caption import GENERATION_KWARGS, generate_captions, get_target_size, load_image
+from continuous_batching import build_cache, cache_layers, sample_next_tokens
+from multi_style import encode_images, image_token_id
+from sources import iter_images
+
+CONFIG_NAME = "onnx_config.json"
+
+
+class VisionEncoder(torch.nn.Module):
+    """Vision tower, feature layer selection and projector as one graph: pixel_values -> image features."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return encode_images(self.model, pixel_values)
+
+
+class Decoder(torch.nn.Module):
+    """Language model and output head with the KV cache passed in and out as flat tensors."""
+
+    def __init__(self, model, num_layers):
+        super().__init__()
+        base = getattr(model, "model", model)
+        self.language_model = base.language_model
+        self.lm_head = model.lm_head
+        self.num_layers = num_layers
+
+    def forward(self, inputs_embeds, attention_mask, position_ids, *past):
+        cache = build_cache([(past[2 * i], past[2 * i + 1]) for i in range(self.num_layers)])
+        outputs = self.language_model(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            use_cache=True,
+        )
+        present = []
+        for keys, values in cache_layers(outputs.past_key_values):
+            present.extend([keys, values])
+        return (self.lm_head(outputs.last_hidden_state), *present)
+
+
+def past_names(num_layers, prefix):
+    return [f"{prefix}.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+
+
+def export_onnx(model_path, output_dir, opset=17, log=print):
+    """Export the vision encoder and the decoder to ONNX, plus the embedding table and processor."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    processor = AutoProcessor.from_pretrained(model_path)
+    model = LlavaForConditionalGeneration.from_pretrained(model_path, torch_dtype=torch.float32)
+    model.eval()
+
+    text_config = model.config.text_config
+    num_layers = text_config.num_hidden_layers
+    num_heads = text_config.num_attention_heads
+    kv_heads = getattr(text_config, "num_key_value_heads", None) or num_heads
+    head_dim = getattr(text_config, "head_dim", None) or text_config.hidden_size // num_heads
+
+    width, height = get_target_size(processor) or (336, 336)
+    log(f"Exporting vision encoder to {output_dir / 'vision.onnx'}")
+    with warnings.catch_warnings(), torch.no_grad():
+        warnings.simplefilter("ignore")
+        torch.onnx.export(
+            VisionEncoder(model), (torch.randn(1, 3, height, width),), str(output_dir / "vision.onnx"),
+            input_names=["pixel_values"], output_names=["image_features"],
+            dynamic_axes={"pixel_values": {0: "images"}, "image_features": {0: "images"}},
+            opset_version=opset, dynamo=False,
+        )
+
+        log(f"Exporting language model to {output_dir / 'decoder.onnx'}")
+        batch, length, past = 2, 4, 3
+        inputs = (
+            torch.randn(batch, length, text_config.hidden_size),
+            torch.ones(batch, past + length, dtype=torch.long),
+            torch.arange(past, past + length).repeat(batch, 1),
+            *[torch.randn(batch, kv_heads, past, head_dim) for _ in range(2 * num_layers)],
+        )
+        dynamic_axes = {
+            "inputs_embeds": {0: "batch", 1: "length"},
+            "attention_mask": {0: "batch", 1: "total_length"},
+            "position_ids": {0: "batch", 1: "length"},
+            "logits": {0: "batch", 1: "length"},
+        }
+        dynamic_axes.update({name: {0: "batch", 2: "past_length"} for name in past_names(num_layers, "past")})
+        dynamic_axes.update({name: {0: "batch", 2: "total_length"} for name in past_names(num_layers, "present")})
+        torch.onnx.export(
+            Decoder(model, num_layers), inputs, str(output_dir / "decoder.onnx"),
+            input_names=["inputs_embeds", "attention_mask", "position_ids", *past_names(num_layers, "past")],
+            output_names=["logits", *past_names(num_layers, "present")],
+            dynamic_axes=dynamic_axes, opset_version=opset, dynamo=False,
+        )
+
+    np.save(output_dir / "embed_tokens.npy", model.get_input_embeddings().weight.detach().numpy())
+    eos_token_id = model.generation_config.eos_token_id
+    if eos_token_id is None:
+        eos_token_id = text_config.eos_token_id
+    config = {
+        "source": str(model_path),
+        "opset": opset,
+        "num_layers": num_layers,
+        "kv_heads": kv_heads,
+        "head_dim": head_dim,
+        "image_token_id": image_token_id(model),
+        "eos_token_id": eos_token_id if isinstance(eos_token_id, list) else [eos_token_id],
+        "pad_token_id": processor.tokenizer.pad_token_id,
+    }
+    (output_dir / CONFIG_NAME).write_text(json.dumps(config, indent=2))
+    processor.save_pretrained(output_dir)
+    log("Export finished")
+    return output_dir
+
+
+class OnnxLlavaModel:
+    """Exported model run with ONNX Runtime behind the same generate() call batch_caption uses.
+
+    Token embeddings are looked up from a NumPy table, image features from vision.onnx are
+    scattered into the image token positions, and decoder.onnx runs a prefill followed by one
+    step per token. The KV cache stays in ONNX Runtime buffers between steps via IO binding.
+    """
+
+    device = torch.device("cpu")
+
+    def __init__(self, path, threads=None, interop_threads=None, providers=None):
+        import onnxruntime
+
+        self.ort = onnxruntime
+        path = Path(path)
+        self.config = json.loads((path / CONFIG_NAME).read_text())
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        if interop_threads:
+            options.inter_op_num_threads = interop_threads
+        providers = providers or ["CPUExecutionProvider"]
+        self.vision = onnxruntime.InferenceSession(str(path / "vision.onnx"), options, providers=providers)
+        self.decoder = onnxruntime.InferenceSession(str(path / "decoder.onnx"), options, providers=providers)
+        self.embed_tokens = np.load(path / "embed_tokens.npy")
+        self.past_names = past_names(self.config["num_layers"], "past")
+        self.present_names = past_names(self.config["num_layers"], "present")
+
+    def embed(self, input_ids, pixel_values=None):
+        embeddings = self.embed_tokens[input_ids]
+        if pixel_values is not None:
+            features = self.vision.run(None, {"pixel_values": pixel_values.astype(np.float32)})[0]
+            mask = input_ids == self.config["image_token_id"]
+            features = features.reshape(-1, features.shape[-1])
+            if mask.sum() != features.shape[0]:
+                raise ValueError(f"Prompt has {mask.sum()} image tokens but the images produced {features.shape[0]} features")
+            embeddings[mask] = features
+        return embeddings
+
+    def decode(self, binding, inputs_embeds, attention_mask, position_ids, past):
+        binding.clear_binding_inputs()
+        binding.clear_binding_outputs()
+        binding.bind_cpu_input("inputs_embeds", np.ascontiguousarray(inputs_embeds, dtype=np.float32))
+        binding.bind_cpu_input("attention_mask", np.ascontiguousarray(attention_mask, dtype=np.int64))
+        binding.bind_cpu_input("position_ids", np.ascontiguousarray(position_ids, dtype=np.int64))
+        for name, value in zip(self.past_names, past):
+            binding.bind_ortvalue_input(name, value)
+        binding.bind_output("logits")
+        for name in self.present_names:
+            binding.bind_output(name)
+        self.decoder.run_with_iobinding(binding)
+        outputs = binding.get_outputs()
+        return outputs[0].numpy()[:, -1], list(outputs[1:])
+
+    def generate(self, input_ids, attention_mask, pixel_values=None, max_new_tokens=512, do_sample=True,
+                 temperature=0.6, top_p=0.9, top_k=None, streamer=None, stopping_criteria=None, **unused):
+        """Return prompt plus generated token ids, padded after EOS, like transformers' generate."""
+        prompt_ids = input_ids.cpu()
+        if streamer is not None:
+            streamer.put(prompt_ids)
+        input_ids = prompt_ids.numpy()
+        attention_mask = attention_mask.cpu().numpy().astype(np.int64)
+        if pixel_values is not None:
+            pixel_values = pixel_values.cpu().float().numpy()
+        batch = input_ids.shape[0]
+
+        position_ids = np.cumsum(attention_mask, axis=-1) - 1
+        position_ids[attention_mask == 0] = 1
+        empty = np.zeros((batch, self.config["kv_heads"], 0, self.config["head_dim"]), dtype=np.float32)
+        past = [self.ort.OrtValue.ortvalue_from_numpy(empty) for _ in self.past_names]
+        binding = self.decoder.io_binding()
+        logits, past = self.decode(binding, self.embed(input_ids, pixel_values), attention_mask, position_ids, past)
+
+        eos = torch.tensor(self.config["eos_token_id"])
+        pad = self.config["pad_token_id"]
+        finished = torch.zeros(batch, dtype=torch.bool)
+        tokens = []
+        for _ in range(max_new_tokens):
+            next_tokens = sample_next_tokens(torch.from_numpy(logits), do_sample, temperature, top_p, top_k)
+            next_tokens = next_tokens.masked_fill(finished, pad)
+            tokens.append(next_tokens)
+            if streamer is not None:
+                streamer.put(next_tokens)
+            finished |= torch.isin(next_tokens, eos)
+            if finished.all():
+                break
+            if stopping_criteria is not None:
+                sequences = torch.cat([prompt_ids, torch.stack(tokens, dim=1)], dim=1)
+                if bool(stopping_criteria(sequences, torch.from_numpy(logits)).all()):
+                    break
+            attention_mask = np.concatenate([attention_mask, np.ones((batch, 1), dtype=np.int64)], axis=1)
+            position_ids = attention_mask.sum(axis=1, keepdims=True) - 1
+            step_ids = next_tokens.numpy()[:, None]
+            logits, past = self.decode(binding, self.embed_tokens[step_ids], attention_mask, position_ids, past)
+
+        if streamer is not None:
+            streamer.end()
+        if not tokens:
+            return prompt_ids
+        return torch.cat([prompt_ids, torch.stack(tokens, dim=1)], dim=1)
+
+    def eval(self):
+        return self
+
+
+def load_onnx_model(model_path, device_map=None, threads=None, interop_threads=None):
+    """Load a directory written by export_onnx; model_path is the export directory."""
+    print("Loading JoyCaption ONNX model")
+    processor = AutoProcessor.from_pretrained(model_path)
+    processor.tokenizer.padding_side = "left"
+    model = OnnxLlavaModel(model_path, threads=threads, interop_threads=interop_threads)
+    print("Model loaded successfully!")
+    return processor, model
+
+
+def sample_images(folder=None, count=4, size=64):
+    """Images from folder, or random noise images when no folder is given."""
+    images = []
+    if folder:
+        for image_file in iter_images(folder):
+            try:
+                images.append(load_image(image_file))
+            except Exception as e:
+                print(f"Error loading {image_file}: {str(e)}")
+            if len(images) >= count:
+                break
+        return images
+    generator = np.random.default_rng(0)
+    for _ in range(count):
+        images.append(Image.fromarray(generator.integers(0, 256, (size, size, 3), dtype=np.uint8)))
+    return images
+
+
+def parity_check(model_path=None, onnx_path=None, folder=None, count=4, batch_size=2, max_new_tokens=32):
+    """Compare greedy captions of the transformers model and its ONNX export; returns True when all match.
+
+    Without model_path a tiny random-weight LLaVA is built and exported in a temporary directory.
+    """
+    with tempfile.TemporaryDirectory() as scratch:
+        if model_path is None:
+            from tiny_llava import build_tiny_llava
+
+            model_path = build_tiny_llava(Path(scratch) / "tiny")
+        if onnx_path is None:
+            onnx_path = export_onnx(model_path, Path(scratch) / "onnx")
+
+        images = sample_images(folder, count)
+        generation_kwargs = dict(GENERATION_KWARGS, do_sample=False, temperature=None, top_p=None,
+                                 max_new_tokens=max_new_tokens)
+
+        processor = AutoProcessor.from_pretrained(model_path)
+        processor.tokenizer.padding_side = "left"
+        model = LlavaForConditionalGeneration.from_pretrained(model_path, torch_dtype=torch.float32, device_map="cpu")
+        model.eval()
+        onnx_processor, onnx_model = load_onnx_model(onnx_path)
+
+        matches = 0
+        for start in range(0, len(images), batch_size):
+            batch = images[start:start + batch_size]
+            expected = generate_captions(processor, model, batch, "descriptive", generation_kwargs=generation_kwargs)
+            actual = generate_captions(onnx_processor, onnx_model, batch, "descriptive", generation_kwargs=generation_kwargs)
+            for i, (a, b) in enumerate(zip(expected, actual), start=start):
+                if a == b:
+                    matches += 1
+                else:
+                    print(f"Image {i} differs:\n  transformers: {a}\n  onnx:         {b}")
+
+    print(f"Parity: {matches}/{len(images)} captions identical")
+    return matches == len(images)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export JoyCaption to ONNX and check it against transformers")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="Export a model for --backend onnx")
+    export.add_argument("model", help="Path to JoyCaption model")
+    export.add_argument("output", help="Directory for the ONNX files")
+    export.add_argument("--opset", type=int, default=17,
+                       help="ONNX opset version")
+
+    parity = commands.add_parser("parity", help="Compare greedy captions of transformers and ONNX Runtime")
+    parity.add_argument("--model",
+                       help="Model to check; a tiny random-weight LLaVA is built when omitted")
+    parity.add_argument("--onnx",
+                       help="Existing export of --model; exported to a temporary directory when omitted")
+    parity.add_argument("--images",
+                       help="Folder with sample images; random images are used when omitted")
+    parity.add_argument("--count", type=int, default=4,
+                       help="Number of images compared")
+    parity.add_argument("--batch-size", type=int, default=2,
+                       help="Number of images captioned per generate call")
+    parity.add_argument("--max-new-tokens", type=int, default=32,
+                       help="Caption length compared")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        export_onnx(args.model, args.output, opset=args.opset)
+    elif not parity_check(args.model, args.onnx, args.images, args.count, max(1, args.batch_size), args.max_new_tokens):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import queue
+import threading
+import time
+
+from batch_caption import collate_inputs, generate_from_inputs, load_image, move_to_device, preprocess, write_caption
+from metrics import metrics
+
+DONE = object()
+
+
+class StageQueue:
+    """Bounded queue that records how long its producers and consumer spent blocked."""
+
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = max(1, maxsize)
+        self.queue = queue.Queue(self.maxsize)
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+        self.max_depth = 0
+        self.items = 0
+
+    def put(self, item, stop_event):
+        start = time.perf_counter()
+        while not stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            if item is not DONE:
+                self.items += 1
+            depth = self.queue.qsize()
+            self.max_depth = max(self.max_depth, depth)
+            metrics.gauge("queue_depth", depth, queue=self.name)
+            break
+        self.put_wait += time.perf_counter() - start
+
+    def get(self, stop_event, block=True):
+        start = time.perf_counter()
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=0.1) if block else self.queue.get_nowait()
+                    metrics.gauge("queue_depth", self.queue.qsize(), queue=self.name)
+                    return item
+                except queue.Empty:
+                    if not block or stop_event.is_set():
+                        return None
+        finally:
+            self.get_wait += time.perf_counter() - start
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def report(self):
+        return (f"{self.name}: {self.items} items, max depth {self.max_depth}/{self.maxsize}, "
+                f"producers blocked {self.put_wait:.2f}s, consumer starved {self.get_wait:.2f}s")
+
+
+class CaptionPipeline:
+    """Overlap image decoding, preprocessing, generation and file writes.
+
+    Reader threads decode images, preprocessing workers turn them into processor outputs,
+    the calling thread runs the model on batches and a writer thread saves the captions.
+    Every hand-off goes through a bounded queue, so a slow stage applies back-pressure
+    instead of letting decoded images pile up in memory.
+    """
+
+    def __init__(self, processor, model, style="descriptive", batch_size=1, num_readers=2,
+                 num_preprocessors=2, read_queue_depth=8, preprocess_queue_depth=8,
+                 write_queue_depth=32, write_fn=write_caption, log=print, target_size=None, generation_kwargs=None,
+                 on_error=None):
+        self.processor = processor
+        self.model = model
+        self.style = style
+        self.batch_size = max(1, batch_size)
+        self.num_readers = max(1, num_readers)
+        self.num_preprocessors = max(1, num_preprocessors)
+        self.write_fn = write_fn
+        self.log = log
+        self.on_error = on_error
+        self.target_size = target_size
+        self.generation_kwargs = generation_kwargs
+
+        self.paths = StageQueue("paths", read_queue_depth)
+        self.decoded = StageQueue("decode -> preprocess", read_queue_depth)
+        self.preprocessed = StageQueue("preprocess -> model", preprocess_queue_depth)
+        self.to_write = StageQueue("model -> writer", write_queue_depth)
+        self.stop_event = threading.Event()
+        self.feed_error = None
+        self.lock = threading.Lock()
+        self.stage_times = {"decode": 0.0, "preprocess": 0.0, "generate": 0.0, "write": 0.0}
+
+    def _add_time(self, stage, seconds):
+        with self.lock:
+            self.stage_times[stage] += seconds
+
+    def _feed(self, image_paths):
+        try:
+            for image_path in image_paths:
+                if self.stop_event.is_set():
+                    break
+                self.paths.put(image_path, self.stop_event)
+        except Exception as e:
+            # Let the images already queued finish, then raise from run()
+            self.feed_error = e
+        finally:
+            for _ in range(self.num_readers):
+                self.paths.put(DONE, self.stop_event)
+
+    def _read(self):
+        while True:
+            image_path = self.paths.get(self.stop_event)
+            if image_path is None or image_path is DONE:
+                break
+            start = time.perf_counter()
+            try:
+                item = (image_path, load_image(image_path, self.target_size), None)
+            except Exception as e:
+                item = (image_path, None, e)
+            self._add_time("decode", time.perf_counter() - start)
+            self.decoded.put(item, self.stop_event)
+
+    def _preprocess(self):
+        while True:
+            item = self.decoded.get(self.stop_event)
+            if item is None or item is DONE:
+                break
+            image_path, image, error = item
+            inputs = None
+            if error is None:
+                start = time.perf_counter()
+                try:
+                    inputs = preprocess(self.processor, [image], self.style)
+                except Exception as e:
+                    error = e
+                self._add_time("preprocess", time.perf_counter() - start)
+            self.preprocessed.put((image_path, inputs, error), self.stop_event)
+
+    def _write(self, results):
+        while True:
+            item = self.to_write.get(self.stop_event)
+            if item is DONE or (item is None and self.stop_event.is_set()):
+                break
+            if item is None:
+                continue
+            image_path, caption = item
+            start = time.perf_counter()
+            try:
+                self.write_fn(image_path, caption)
+                results["saved"] += 1
+            except Exception as e:
+                self.log(f"Error saving caption for {image_path}: {str(e)}")
+                if self.on_error:
+                    self.on_error(image_path, f"saving the caption failed: {str(e)}")
+            self._add_time("write", time.perf_counter() - start)
+
+    def _fail(self, image_path, error):
+        self.log(f"Error captioning {image_path}: {str(error)}")
+        if self.on_error:
+            self.on_error(image_path, str(error))
+
+    def _generate(self, batch):
+        start = time.perf_counter()
+        try:
+            inputs = collate_inputs(self.processor, [inputs for _, inputs in batch])
+            captions = generate_from_inputs(self.processor, self.model, move_to_device(inputs), self.generation_kwargs)
+        except Exception as e:
+            if len(batch) == 1:
+                self._fail(batch[0][0], e)
+                captions = [None]
+            else:
+                # Retry one image at a time to isolate the input that broke the batch
+                captions = [caption for item in batch for caption in self._generate([item])]
+        self._add_time("generate", time.perf_counter() - start)
+        return captions
+
+    def _start(self, target, *args, count=1):
+        threads = [threading.Thread(target=target, args=args, daemon=True) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def _close_stage(self, threads, downstream, count):
+        for thread in threads:
+            thread.join()
+        for _ in range(count):
+            downstream.put(DONE, self.stop_event)
+
+    def run(self, image_paths, should_stop=None, on_result=None):
+        """Caption image_paths and return a summary dict.
+
+        on_result(image_path, caption) is called from the model thread as each caption is
+        generated (caption is None on failure); should_stop() is polled between batches and after
+        each generate call. A batch that finishes after should_stop() turned true is dropped, since
+        a stopping criterion may have cut its captions short. An exception raised by image_paths
+        is raised here once the images read before it have been captioned and written.
+        """
+        self.stop_event.clear()
+        self.feed_error = None
+        results = {"captioned": 0, "failed": 0, "saved": 0}
+
+        self._start(self._feed, image_paths)
+        readers = self._start(self._read, count=self.num_readers)
+        preprocessors = self._start(self._preprocess, count=self.num_preprocessors)
+        writer = self._start(self._write, results)
+        # Each stage forwards end-of-input once all of its own workers are finished
+        self._start(self._close_stage, readers, self.decoded, self.num_preprocessors)
+        self._start(self._close_stage, preprocessors, self.preprocessed, 1)
+
+        finished = False
+        while not finished:
+            if should_stop and should_stop():
+                self.stop_event.set()
+                break
+
+            batch = []
+            item = self.preprocessed.get(self.stop_event)
+            while item is not None:
+                if item is DONE:
+                    finished = True
+                    break
+                image_path, inputs, error = item
+                if error is not None:
+                    self._fail(image_path, error)
+                    results["failed"] += 1
+                    if on_result:
+                        on_result(image_path, None)
+                else:
+                    batch.append((image_path, inputs))
+                if len(batch) >= self.batch_size:
+                    break
+                # Fill the batch with whatever is already prepared, without waiting for more
+                item = self.preprocessed.get(self.stop_event, block=False)
+
+            if not batch:
+                continue
+
+            captions = self._generate(batch)
+            if should_stop and should_stop():
+                self.stop_event.set()
+                break
+            for (image_path, _), caption in zip(batch, captions):
+                if caption:
+                    results["captioned"] += 1
+                    self.to_write.put((image_path, caption), self.stop_event)
+                else:
+                    results["failed"] += 1
+                if on_result:
+                    on_result(image_path, caption)
+
+        self.to_write.put(DONE, self.stop_event)
+        for thread in writer:
+            thread.join()
+        if self.feed_error is not None:
+            raise self.feed_error
+        return results
+
+    def report(self):
+        lines = ["Pipeline stage times (summed over workers):"]
+        for stage, seconds in self.stage_times.items():
+            lines.append(f"  {stage}: {seconds:.2f}s")
+        lines.append("Back-pressure:")
+        for stage_queue in (self.paths, self.decoded, self.preprocessed, self.to_write):
+            lines.append(f"  {stage_queue.report()}")
+        return "\n".join(lines)
@@ -0,0 +1,115 @@
+import hashlib
+import threading
+
+import torch
+
+from metrics import metrics
+
+
+def processor_revision(processor):
+    """Fingerprint the parts of a processor that decide how a prompt is rendered and tokenized."""
+    tokenizer = processor.tokenizer
+    parts = [
+        getattr(tokenizer, "name_or_path", ""),
+        str(len(tokenizer)),
+        str(getattr(processor, "chat_template", None) or getattr(tokenizer, "chat_template", None)),
+        processor.image_processor.to_json_string(),
+    ]
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+class PromptCache:
+    """Per-style cache of the rendered chat template, its token ids and the KV of the text prefix.
+
+    Every image of a run uses the same prompt, so the template only needs to be rendered and
+    tokenized once per style and image shape. Only the image processor runs per image. Entries
+    are keyed by style, model path and processor revision, so a cache is never reused across
+    models or processor configurations.
+    """
+
+    def __init__(self, processor, render):
+        self.processor = processor
+        self.render = render
+        self.model_path = getattr(processor.tokenizer, "name_or_path", "")
+        self.revision = processor_revision(processor)
+        self.image_token_id = self._image_token_id()
+        self.entries = {}
+        self.lock = threading.Lock()
+        # Falls back to the full processor if its output has fields the cache does not reproduce
+        self.enabled = True
+
+    def _image_token_id(self):
+        image_token_id = getattr(self.processor, "image_token_id", None)
+        if image_token_id is None and getattr(self.processor, "image_token", None):
+            image_token_id = self.processor.tokenizer.convert_tokens_to_ids(self.processor.image_token)
+        return image_token_id
+
+    def key(self, style):
+        return (style, self.model_path, self.revision)
+
+    def _entry(self, style):
+        key = self.key(style)
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = {"convo_string": self.render(style), "input_ids": {}, "prefix": {}}
+            return self.entries[key]
+
+    def convo_string(self, style):
+        return self._entry(style)["convo_string"]
+
+    def preprocess(self, images, style):
+        """Equivalent of processor(text=[convo_string] * len(images), images=images)."""
+        entry = self._entry(style)
+        if not self.enabled:
+            return self.processor(text=[entry["convo_string"]] * len(images), images=images,
+                                  return_tensors="pt", padding=True)
+
+        image_inputs = self.processor.image_processor(images=images, return_tensors="pt")
+        pixel_values = image_inputs["pixel_values"]
+        shape = tuple(pixel_values.shape[1:])
+        input_ids = entry["input_ids"].get(shape)
+        metrics.count("prompt_cache_hits" if input_ids is not None else "prompt_cache_misses")
+        if input_ids is None:
+            full = self.processor(text=[entry["convo_string"]], images=images[:1], return_tensors="pt")
+            if set(full.keys()) != {"input_ids", "attention_mask", "pixel_values"}:
+                self.enabled = False
+                return self.preprocess(images, style)
+            input_ids = full["input_ids"][0]
+            entry["input_ids"][shape] = input_ids
+
+        batch = dict(image_inputs)
+        batch["input_ids"] = input_ids.unsqueeze(0).repeat(len(images), 1)
+        batch["attention_mask"] = torch.ones_like(batch["input_ids"])
+        return batch
+
+    def prefix_length(self, input_ids):
+        """Number of leading text tokens before the first image token, shared by every image."""
+        if self.image_token_id is None:
+            return 0
+        positions = (input_ids[0] == self.image_token_id).nonzero()
+        return int(positions[0]) if len(positions) else 0
+
+    def prefix(self, model, style, input_ids, cache_layers):
+        """Return (per-layer key/value tensors, prefix length) for the text before the image, or None.
+
+        The KV is computed once per style and model and then reused for every prefill.
+        """
+        length = self.prefix_length(input_ids)
+        if length == 0:
+            return None
+
+        entry = self._entry(style)
+        model_key = (getattr(model, "name_or_path", ""), length)
+        cached = entry["prefix"].get(model_key)
+        metrics.count("prefix_cache_hits" if cached is not None else "prefix_cache_misses")
+        if cached is None:
+            prefix_ids = input_ids[:1, :length]
+            with torch.no_grad():
+                outputs = model(input_ids=prefix_ids, attention_mask=torch.ones_like(prefix_ids), use_cache=True)
+            cached = [(k.detach(), v.detach()) for k, v in cache_layers(outputs.past_key_values)]
+            entry["prefix"][model_key] = cached
+        return cached, length
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
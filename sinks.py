@@ -0,0 +1,254 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+from pathlib import Path
+
+from batch_caption import caption_path
+from metrics import metrics
+from sources import ShardMember
+
+OUTPUT_FORMATS = ["txt", "jsonl", "parquet", "tar"]
+
+
+def record_key(image_path):
+    if isinstance(image_path, ShardMember):
+        return f"{image_path.shard.resolve()}::{image_path.member}"
+    return str(Path(image_path).resolve())
+
+
+class CaptionSink:
+    """Destination for captions plus an index of what it already holds.
+
+    write() may buffer; buffered records are written flush_every at a time and each flush is
+    atomic, so an interrupted run never leaves a half-written record behind. done() answers
+    skip checks from the index loaded when the sink is opened instead of statting every file.
+    """
+
+    def __init__(self, model=None, style=None, flush_every=256):
+        self.model = str(model) if model is not None else None
+        self.style = style
+        self.flush_every = max(1, flush_every)
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.index = set()
+        self.written = 0
+
+    def done(self, image_path, style=None):
+        return (record_key(image_path), style or self.style) in self.index
+
+    def write(self, image_path, caption, style=None, seconds=None):
+        record = {
+            "path": record_key(image_path),
+            "style": style or self.style,
+            "caption": caption,
+            "model": self.model,
+            "seconds": seconds,
+            "created": time.time(),
+        }
+        with self.lock:
+            self.buffer.append(record)
+            if len(self.buffer) >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        records, self.buffer = self.buffer, []
+        with metrics.stage("flush", records=len(records)):
+            self._write_records(records)
+        self.index.update((record["path"], record["style"]) for record in records)
+        self.written += len(records)
+
+    def _write_records(self, records):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+class TextSink(CaptionSink):
+    """Sidecar .txt next to each image, written immediately as before.
+
+    Skip checks list each image directory once rather than statting one caption file per image.
+    """
+
+    def __init__(self, model=None, style=None, flush_every=1):
+        super().__init__(model, style, flush_every)
+        self.listings = {}
+
+    def _listing(self, folder):
+        listing = self.listings.get(folder)
+        if listing is None:
+            try:
+                listing = set(os.listdir(folder))
+            except OSError:
+                listing = set()
+            self.listings[folder] = listing
+        return listing
+
+    def done(self, image_path, style=None):
+        path = caption_path(image_path, style)
+        return path.name in self._listing(path.parent)
+
+    def write(self, image_path, caption, style=None, seconds=None):
+        path = caption_path(image_path, style)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(caption)
+        with self.lock:
+            self.written += 1
+            if path.parent in self.listings:
+                self.listings[path.parent].add(path.name)
+
+
+class JsonlSink(CaptionSink):
+    """Append-only JSON Lines file, one record per caption."""
+
+    def __init__(self, path, model=None, style=None, flush_every=256):
+        super().__init__(model, style, flush_every)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.exists():
+            self._load()
+
+    def _load(self):
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            # A crash mid-append can leave a torn last line; cut it so new records start cleanly
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                f.truncate(end)
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            self.index.add((record["path"], record["style"]))
+
+    def _write_records(self, records):
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class ShardSink(CaptionSink):
+    """Directory of immutable shard files, each written to a temporary name and renamed into place."""
+
+    suffix = None
+
+    def __init__(self, path, model=None, style=None, flush_every=1024):
+        super().__init__(model, style, flush_every)
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.shards = sorted(self.path.glob(f"part-*{self.suffix}"))
+        for shard in self.shards:
+            for image_path, style in self._read_index(shard):
+                self.index.add((image_path, style))
+
+    def _next_shard(self):
+        number = int(self.shards[-1].name[5:10]) + 1 if self.shards else 0
+        return self.path / f"part-{number:05d}{self.suffix}"
+
+    def _write_records(self, records):
+        shard = self._next_shard()
+        temp = shard.with_name(shard.name + ".tmp")
+        self._write_shard(temp, records)
+        with open(temp, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(temp, shard)
+        self.shards.append(shard)
+
+    def _read_index(self, shard):
+        raise NotImplementedError
+
+    def _write_shard(self, path, records):
+        raise NotImplementedError
+
+
+class ParquetSink(ShardSink):
+    """Parquet dataset with path, style, caption, model, seconds and created columns. Needs pyarrow."""
+
+    suffix = ".parquet"
+
+    def __init__(self, path, model=None, style=None, flush_every=1024):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow: pip install pyarrow") from None
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        super().__init__(path, model, style, flush_every)
+
+    def _read_index(self, shard):
+        table = self.pq.read_table(shard, columns=["path", "style"])
+        return zip(table.column("path").to_pylist(), table.column("style").to_pylist())
+
+    def _write_shard(self, path, records):
+        columns = {name: [record[name] for record in records] for name in records[0]}
+        table = self.pa.table(columns, schema=self.pa.schema([
+            ("path", self.pa.string()),
+            ("style", self.pa.string()),
+            ("caption", self.pa.string()),
+            ("model", self.pa.string()),
+            ("seconds", self.pa.float64()),
+            ("created", self.pa.float64()),
+        ]))
+        self.pq.write_table(table, path)
+
+
+class TarSink(ShardSink):
+    """WebDataset-style tar shards: <key>.txt holds the caption and <key>.json the other fields."""
+
+    suffix = ".tar"
+
+    @staticmethod
+    def sample_key(record):
+        return hashlib.sha1(f"{record['path']}\0{record['style']}".encode("utf-8")).hexdigest()
+
+    def _read_index(self, shard):
+        with tarfile.open(shard) as tar:
+            for member in tar:
+                if member.name.endswith(".json"):
+                    record = json.load(tar.extractfile(member))
+                    yield record["path"], record["style"]
+
+    def _write_shard(self, path, records):
+        with tarfile.open(path, 'w') as tar:
+            for record in records:
+                key = self.sample_key(record)
+                meta = {name: value for name, value in record.items() if name != "caption"}
+                for name, data in ((f"{key}.txt", record["caption"]), (f"{key}.json", json.dumps(meta))):
+                    data = data.encode("utf-8")
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = int(record["created"])
+                    tar.addfile(info, io.BytesIO(data))
+
+
+def open_sink(output_format, output=None, folder=".", model=None, style=None, flush_every=None):
+    """Open the sink for output_format; output defaults to a captions file or directory inside folder."""
+    if output_format == "txt":
+        return TextSink(model, style)
+
+    kwargs = {"model": model, "style": style}
+    if flush_every:
+        kwargs["flush_every"] = flush_every
+    if output_format == "jsonl":
+        return JsonlSink(output or Path(folder) / "captions.jsonl", **kwargs)
+    if output_format == "parquet":
+        return ParquetSink(output or Path(folder) / "captions_parquet", **kwargs)
+    if output_format == "tar":
+        return TarSink(output or Path(folder) / "captions_tar", **kwargs)
+    raise ValueError(f"unknown output format: {output_format}")
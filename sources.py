@@ -0,0 +1,185 @@
+import io
+import os
+import tarfile
+import zipfile
+from functools import lru_cache
+from itertools import islice
+from pathlib import Path, PurePosixPath
+
+from PIL import Image
+
+SUPPORTED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif', '.webp'}
+SHARD_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.zip')
+
+
+class ShardMember:
+    """An image stored inside a tar or zip shard, identified as <shard>::<member>.
+
+    Members read while streaming a shard carry their bytes, so captioning never reopens the shard.
+    Zip and uncompressed tar members drop them after the first open() and read the shard again
+    when needed, an uncompressed tar with one seek to the kept data offset. Compressed tars can
+    only be read from the start, so their members keep their bytes.
+    """
+
+    def __init__(self, shard, member, data=None, offset=None, size=None):
+        self.shard = Path(shard)
+        self.member = member
+        self.data = data
+        self.offset = offset
+        self.size = size
+
+    @property
+    def name(self):
+        return PurePosixPath(self.member).name
+
+    @property
+    def stem(self):
+        return PurePosixPath(self.member).stem
+
+    @property
+    def suffix(self):
+        return PurePosixPath(self.member).suffix
+
+    def open(self, mode='rb'):
+        data = self.data
+        if self.offset is not None or is_zip(self.shard):
+            # These can be read again cheaply, so the bytes are not kept after the first read
+            self.data = None
+        if data is None:
+            if self.offset is not None:
+                with open(self.shard, 'rb') as f:
+                    f.seek(self.offset)
+                    data = f.read(self.size)
+            elif is_zip(self.shard):
+                data = zip_archive(self.shard).read(self.member)
+            else:
+                with tarfile.open(self.shard) as archive:
+                    data = archive.extractfile(self.member).read()
+        return io.BytesIO(data)
+
+    def __str__(self):
+        return f"{self.shard}::{self.member}"
+
+    def __repr__(self):
+        return f"ShardMember({str(self)!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, ShardMember) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+def is_zip(path):
+    return str(path).lower().endswith('.zip')
+
+
+def is_shard(path):
+    return str(path).lower().endswith(SHARD_SUFFIXES)
+
+
+@lru_cache(maxsize=8)
+def zip_archive(path):
+    # Reading the central directory of a large zip is slow, so archives stay open for rereads
+    return zipfile.ZipFile(path)
+
+
+def has_extension(name, extensions):
+    return os.path.splitext(name)[1].lower() in extensions
+
+
+def open_file(image_path):
+    """Binary file object for a path on disk or a shard member."""
+    if isinstance(image_path, ShardMember):
+        return image_path.open()
+    return open(image_path, 'rb')
+
+
+def open_image(image_path):
+    if isinstance(image_path, ShardMember):
+        return Image.open(image_path.open())
+    return Image.open(image_path)
+
+
+def scan_folder(folder, recursive=False, extensions=SUPPORTED_EXTENSIONS, shards=False):
+    """Yield image files under folder with one os.scandir pass per directory.
+
+    Subdirectories are walked depth first when recursive is set. With shards, tar and zip files
+    found along the way are yielded as well so the caller can expand them.
+    """
+    stack = [Path(folder)]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            continue
+        subdirectories = []
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if recursive:
+                            subdirectories.append(Path(entry.path))
+                    elif has_extension(entry.name, extensions) or (shards and is_shard(entry.name)):
+                        yield Path(entry.path)
+                except OSError:
+                    continue
+        stack.extend(reversed(subdirectories))
+
+
+def iter_shard(shard, extensions=SUPPORTED_EXTENSIONS, keep_data=True):
+    """Yield the images inside a tar (including WebDataset shards) or zip file without extracting it.
+
+    Without keep_data, members of zips and uncompressed tars are yielded without their bytes, so
+    a caller can hold every member of a large shard in a list. Compressed tars cannot be read at
+    an offset, so their members always carry their bytes.
+    """
+    if is_zip(shard):
+        with zipfile.ZipFile(shard) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and has_extension(info.filename, extensions):
+                    yield ShardMember(shard, info.filename, archive.read(info) if keep_data else None)
+    else:
+        # Stream mode reads the tar front to back, which also works for compressed shards
+        plain = str(shard).lower().endswith('.tar')
+        with tarfile.open(shard, 'r|*') as archive:
+            for info in archive:
+                if info.isfile() and has_extension(info.name, extensions):
+                    data = archive.extractfile(info).read() if keep_data or not plain else None
+                    yield ShardMember(shard, info.name, data,
+                                      offset=info.offset_data if plain else None, size=info.size)
+
+
+def iter_images(source, recursive=False, extensions=SUPPORTED_EXTENSIONS, shards=False, log=print,
+                keep_data=True):
+    """Lazily yield images from a folder or a shard file.
+
+    Paths on disk come out as Path objects and images inside shards as ShardMember objects;
+    keep_data is passed on to iter_shard.
+    """
+    source = Path(source)
+    if source.is_file() and is_shard(source):
+        paths = [source]
+        shards = True
+    else:
+        paths = scan_folder(source, recursive, extensions, shards)
+
+    for path in paths:
+        if shards and is_shard(path.name):
+            try:
+                yield from iter_shard(path, extensions, keep_data)
+            except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+                log(f"Error reading shard {path}: {str(e)}")
+        else:
+            yield path
+
+
+def batched(iterable, size):
+    """Yield lists of up to size items from any iterable."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
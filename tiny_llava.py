@@ -0,0 +1,78 @@
+import argparse
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import (CLIPImageProcessor, CLIPVisionConfig, LlamaConfig, LlavaConfig,
+                          LlavaForConditionalGeneration, LlavaProcessor, PreTrainedTokenizerFast)
+
+CHAT_TEMPLATE = (
+    "{% for m in messages %}<{{ m['role'] }}>{% if m['role'] == 'user' %}<image>{% endif %}"
+    "{{ m['content'] }}\n{% endfor %}{% if add_generation_prompt %}<assistant>{% endif %}"
+)
+
+
+def build_tiny_llava(output_dir, image_size=32, patch_size=8, hidden_size=32, num_layers=2, seed=0):
+    """Save a tiny random-weight LLaVA model and processor to output_dir, without downloading anything.
+
+    The character-level tokenizer and small vision/text towers keep the architecture and the
+    processor/chat-template plumbing of JoyCaption, so every code path runs in seconds on a CPU.
+    Captions are random text.
+    """
+    specials = ["<pad>", "<s>", "</s>", "<image>", "<unk>"]
+    vocab = {token: i for i, token in enumerate(specials)}
+    for char in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.,:'-|<>_ \n":
+        vocab.setdefault(char, len(vocab))
+
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Split("", "isolated")
+    tokenizer.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token="<pad>", bos_token="<s>", eos_token="</s>", unk_token="<unk>",
+        additional_special_tokens=["<image>"],
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+
+    image_processor = CLIPImageProcessor(size={"shortest_edge": image_size},
+                                         crop_size={"height": image_size, "width": image_size})
+    processor = LlavaProcessor(
+        image_processor=image_processor, tokenizer=tokenizer, patch_size=patch_size,
+        num_additional_image_tokens=1, vision_feature_select_strategy="full", chat_template=CHAT_TEMPLATE,
+    )
+
+    config = LlavaConfig(
+        vision_config=CLIPVisionConfig(
+            hidden_size=hidden_size, intermediate_size=hidden_size * 2, num_hidden_layers=num_layers,
+            num_attention_heads=2, image_size=image_size, patch_size=patch_size,
+        ),
+        text_config=LlamaConfig(
+            vocab_size=len(tokenizer), hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+            num_hidden_layers=num_layers, num_attention_heads=2, num_key_value_heads=2,
+            pad_token_id=0, bos_token_id=1, eos_token_id=2,
+        ),
+        image_token_index=vocab["<image>"],
+        vision_feature_select_strategy="full",
+        vision_feature_layer=-1,
+    )
+    torch.manual_seed(seed)
+    model = LlavaForConditionalGeneration(config)
+    model.save_pretrained(output_dir)
+    processor.save_pretrained(output_dir)
+    return output_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a tiny random-weight LLaVA model for tests and benchmarks")
+    parser.add_argument("output", help="Directory to save the model and processor to")
+    parser.add_argument("--image-size", type=int, default=32,
+                       help="Vision tower input resolution")
+    parser.add_argument("--hidden-size", type=int, default=32,
+                       help="Hidden size of both towers")
+    parser.add_argument("--layers", type=int, default=2,
+                       help="Layers in both towers")
+
+    args = parser.parse_args()
+    build_tiny_llava(args.output, image_size=args.image_size, hidden_size=args.hidden_size, num_layers=args.layers)
+    print(f"Saved tiny LLaVA model to {args.output}")
+
+if __name__ == "__main__":
+    main()
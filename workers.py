@@ -0,0 +1,245 @@
+import multiprocessing as mp
+import os
+import time
+from collections import deque
+from itertools import chain
+from multiprocessing.connection import wait
+
+
+def parse_cpu_sets(threads_per_worker, num_workers):
+    """Split the CPUs this process may use into one contiguous set per worker."""
+    if not threads_per_worker:
+        return [None] * num_workers
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = list(range(os.cpu_count() or 1))
+    sets = []
+    for i in range(num_workers):
+        start = (i * threads_per_worker) % len(cpus)
+        sets.append([cpus[(start + j) % len(cpus)] for j in range(threads_per_worker)])
+    return sets
+
+
+def worker_main(worker_id, model_path, style, device, cpus, fast_load, backend, backend_options, conn):
+    """Worker process: load a model, then caption whatever batches the parent hands out."""
+    import torch
+
+    from batch_caption import caption_images, get_target_size, load_model
+
+    if cpus:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(len(cpus))
+        torch.set_num_interop_threads(1)
+
+    try:
+        if device and device.startswith("cuda"):
+            torch.cuda.set_device(device)
+        processor, model = load_model(model_path, device_map={"": device} if device else "auto",
+                                      backend=backend, **backend_options)
+        target_size = get_target_size(processor) if fast_load else None
+    except Exception as e:
+        conn.send(("error", str(e)))
+        return
+
+    def log(message):
+        print(f"[worker {worker_id}] {message}")
+
+    conn.send(("ready", []))
+    while True:
+        batch = conn.recv()
+        if batch is None:
+            break
+        errors = {}
+        captions = caption_images(processor, model, batch, style, log=log, target_size=target_size,
+                                  on_error=errors.__setitem__)
+        conn.send(("done", [(image_path, caption, errors.get(image_path))
+                            for image_path, caption in zip(batch, captions)]))
+
+
+class WorkerPool:
+    """Caption images with several worker processes, each holding its own model.
+
+    Workers ask the parent for work whenever they are idle, so a worker stuck on slow images
+    simply takes fewer batches. Each worker talks to the parent over its own pipe, so a worker
+    that dies mid-message cannot block the others. The parent knows what every worker holds:
+    if a worker dies, its in-flight images are requeued one per batch and handed to any idle
+    worker, and a replacement is started while max_restarts allows. An image in flight during
+    max_attempts worker crashes is reported as failed instead of being retried forever.
+    """
+
+    def __init__(self, model_path, style, num_workers=2, batch_size=1, devices=None,
+                 threads_per_worker=None, fast_load=False, backend="default", backend_options=None,
+                 max_attempts=2, max_restarts=None, log=print, on_error=None):
+        self.model_path = model_path
+        self.style = style
+        self.num_workers = max(1, num_workers)
+        self.batch_size = max(1, batch_size)
+        self.devices = devices or []
+        self.cpu_sets = parse_cpu_sets(threads_per_worker, self.num_workers)
+        self.fast_load = fast_load
+        self.backend = backend
+        self.backend_options = backend_options or {}
+        self.max_attempts = max_attempts
+        self.max_restarts = self.num_workers if max_restarts is None else max_restarts
+        self.log = log
+        self.on_error = on_error
+        self.target = worker_main
+
+        self.context = mp.get_context("spawn")
+        self.workers = {}
+        self.processes = []
+        self.restarts = 0
+        self.next_worker_id = 0
+
+    def _spawn(self, slot):
+        worker_id = self.next_worker_id
+        self.next_worker_id += 1
+        device = self.devices[slot % len(self.devices)] if self.devices else None
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=self.target,
+            args=(worker_id, self.model_path, self.style, device, self.cpu_sets[slot], self.fast_load,
+                  self.backend, self.backend_options, child_conn),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        self.processes.append(process)
+        self.workers[worker_id] = {"process": process, "conn": parent_conn, "slot": slot, "in_flight": [],
+                                   "idle": False}
+
+    def _assign(self, worker_id, pending, attempts, on_result):
+        # Images that were in flight during a crash run alone, so they cannot take others down
+        if attempts.get(pending[0]):
+            batch = [pending.popleft()]
+        else:
+            batch = []
+            while pending and len(batch) < self.batch_size and not attempts.get(pending[0]):
+                batch.append(pending.popleft())
+        worker = self.workers[worker_id]
+        worker["idle"] = False
+        try:
+            worker["conn"].send(batch)
+        except (OSError, EOFError):
+            # The worker died before it got the batch, so its images are not counted as a crash attempt
+            pending.extendleft(reversed(batch))
+            self._worker_died(worker_id, pending, attempts, on_result)
+            return
+        worker["in_flight"] = batch
+
+    def _assign_idle(self, pending, attempts, on_result):
+        # A worker that found nothing to do waits on recv(), so images requeued after another
+        # worker crashed have to be pushed to it
+        for worker_id, worker in list(self.workers.items()):
+            if not pending:
+                break
+            if worker_id in self.workers and worker["idle"]:
+                self._assign(worker_id, pending, attempts, on_result)
+
+    def _fail(self, image_path, error):
+        self.log(f"Error captioning {image_path}: {error}")
+        if self.on_error:
+            self.on_error(image_path, error)
+
+    def _retire(self, worker_id):
+        worker = self.workers.pop(worker_id)
+        try:
+            worker["conn"].send(None)
+        except (OSError, EOFError):
+            pass
+        worker["conn"].close()
+
+    def _worker_died(self, worker_id, pending, attempts, on_result):
+        worker = self.workers.pop(worker_id)
+        worker["conn"].close()
+        worker["process"].join(timeout=5)
+        lost = worker["in_flight"]
+        self.log(f"Worker {worker_id} exited with code {worker['process'].exitcode}; "
+                 f"requeueing {len(lost)} images")
+        for image_path in reversed(lost):
+            attempts[image_path] = attempts.get(image_path, 0) + 1
+            if attempts[image_path] >= self.max_attempts:
+                self._fail(image_path, f"worker crashed {attempts[image_path]} times")
+                on_result(image_path, None)
+            else:
+                pending.appendleft(image_path)
+        if pending and self.restarts < self.max_restarts:
+            self.restarts += 1
+            self._spawn(worker["slot"])
+
+    def _refill(self, pending, source):
+        # Only read ahead enough to keep every worker busy, so image_paths can be a lazy generator
+        while len(pending) < self.num_workers * self.batch_size * 2:
+            image_path = next(source, None)
+            if image_path is None:
+                break
+            pending.append(image_path)
+
+    def run(self, image_paths, on_result):
+        """Caption image_paths, calling on_result(image_path, caption) in the parent for each one."""
+        source = iter(image_paths)
+        pending = deque()
+        attempts = {}
+        self._refill(pending, source)
+        for slot in range(min(self.num_workers, len(pending))):
+            self._spawn(slot)
+
+        try:
+            while self.workers:
+                self._refill(pending, source)
+                self._assign_idle(pending, attempts, on_result)
+                if not pending and not any(worker["in_flight"] for worker in self.workers.values()):
+                    break
+                by_handle = {}
+                for worker_id, worker in self.workers.items():
+                    by_handle[worker["conn"]] = worker_id
+                    by_handle[worker["process"].sentinel] = worker_id
+
+                for handle in wait(list(by_handle), timeout=1.0):
+                    worker_id = by_handle[handle]
+                    if worker_id not in self.workers:
+                        continue
+                    worker = self.workers[worker_id]
+                    try:
+                        # Drain a finished result even if the process exited right after sending it
+                        if not worker["conn"].poll():
+                            raise EOFError
+                        kind, payload = worker["conn"].recv()
+                    except (EOFError, OSError):
+                        self._refill(pending, source)
+                        self._worker_died(worker_id, pending, attempts, on_result)
+                        continue
+
+                    if kind == "error":
+                        self.log(f"Worker {worker_id} failed to load the model: {payload}")
+                        self._retire(worker_id)
+                        continue
+
+                    worker["in_flight"] = []
+                    for image_path, caption, error in payload:
+                        # The worker already printed the error; it only has to reach on_error
+                        if error is not None and self.on_error:
+                            self.on_error(image_path, error)
+                        on_result(image_path, caption)
+                    self._refill(pending, source)
+                    if pending:
+                        self._assign(worker_id, pending, attempts, on_result)
+                    else:
+                        worker["idle"] = True
+
+            for image_path in chain(pending, source):
+                self._fail(image_path, "no workers left")
+                on_result(image_path, None)
+        finally:
+            self.shutdown()
+
+    def shutdown(self, timeout=30):
+        for worker_id in list(self.workers):
+            self._retire(worker_id)
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()